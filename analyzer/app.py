@@ -1,11 +1,12 @@
 import connexion
-import json
 import os
 import sys
 import yaml
 import logging
 import logging.config
+import log_setup
 from pykafka import KafkaClient
+import wire
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -29,7 +30,7 @@ with open(APP_CONF_FILE, 'r') as f:
 
 with open(LOG_CONF_FILE, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.setup_logging(log_config)
 
 logger = logging.getLogger('basicLogger')
 
@@ -59,8 +60,7 @@ def get_temperature(index):
     current_index = 0
     try:
         for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = wire.decode(msg.value)
 
             if data["type"] == "temperature":
                 if current_index == index:
@@ -103,8 +103,7 @@ def get_motion(index):
     current_index = 0
     try:
         for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = wire.decode(msg.value)
 
             if data["type"] == "motion":
                 if current_index == index:
@@ -134,8 +133,7 @@ def get_event_stats():
 
     try:
         for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = wire.decode(msg.value)
 
             if data["type"] == "temperature":
                 temperature_count += 1
@@ -181,8 +179,7 @@ def get_temperature_ids():
     
     try:
         for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = wire.decode(msg.value)
             
             if data["type"] == "temperature":
                 payload = data["payload"]
@@ -225,8 +222,7 @@ def get_motion_ids():
     
     try:
         for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = wire.decode(msg.value)
             
             if data["type"] == "motion":
                 payload = data["payload"]
@@ -6,6 +6,7 @@ from datetime import datetime
 import yaml
 import logging
 import logging.config
+import log_setup
 import httpx
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
@@ -20,7 +21,7 @@ APP_CONF_FILE = os.path.join(FULL_CONFIG_PATH, 'consistency_check_app_conf.yml')
 # Load configuration
 with open(LOG_CONF_FILE, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.setup_logging(log_config)
 
 with open(APP_CONF_FILE, 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -6,6 +6,7 @@ from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import logging
 import logging.config
+import log_setup
 import json
 import os
 import yaml
@@ -23,7 +24,7 @@ with open(APP_CONF_FILE, 'r') as f:
 
 with open(LOG_CONF_FILE, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.setup_logging(log_config)
 
 logger = logging.getLogger('processingService')
 logger.info(f"Loading configuration for environment: {ENV}")
@@ -46,6 +47,58 @@ default_stats = {
     'last_event_datetime': "2025-01-01T00:00:00Z"
 }
 
+# Stats key of the reading of each event type, and its field in raw events
+STAT_FIELDS = {
+    'temperature': ('temperature_value', 'temperature'),
+    'motion': ('motion_intensity', 'motion_intensity'),
+}
+
+def fetch_aggregates(params):
+    """ Count, sum, min and max of each event type in the window, computed by storage """
+    stats_url = app_conf['urls']['event_stats']
+    logger.info(f"Querying event aggregates with URL: {stats_url} and params: {params}")
+    response = httpx.get(stats_url, params=params)
+    response.raise_for_status()
+    aggregates = response.json()
+    logger.info(f"Received aggregates of {aggregates['temperature']['count']} temperature and "
+                f"{aggregates['motion']['count']} motion events.")
+    return aggregates
+
+def download_aggregates(params):
+    """ fetch_aggregates computed here from every event in the window, for when storage can't """
+    aggregates = {}
+    for event_type, (_, field) in STAT_FIELDS.items():
+        url = app_conf['urls'][f'{event_type}_events']
+        logger.info(f"Querying {event_type} events with URL: {url} and params: {params}")
+        try:
+            response = httpx.get(url, params=params)
+            logger.info(f"Final URL sent: {response.request.url}")
+            response.raise_for_status()
+            values = [event[field] for event in response.json()]
+            logger.info(f"Received {len(values)} {event_type} events.")
+            aggregates[event_type] = {
+                'count': len(values),
+                'sum': sum(values),
+                'min': min(values, default=None),
+                'max': max(values, default=None)
+            }
+        except Exception as e:
+            logger.error(f"Error querying {event_type} events: {e}")
+    return aggregates
+
+def add_aggregates(stats, aggregates):
+    """ Adds the aggregates of a window to the running stats """
+    for event_type, aggregate in aggregates.items():
+        if not aggregate['count']:
+            continue
+        name = STAT_FIELDS[event_type][0]
+        stats[f'num_{event_type}_events'] += aggregate['count']
+        stats[f'sum_{name}'] += aggregate['sum']
+        stats[f'count_{name}'] += aggregate['count']
+        stats[f'max_{name}'] = max(stats[f'max_{name}'], aggregate['max'])
+        stats[f'min_{name}'] = min(stats[f'min_{name}'], aggregate['min'])
+        stats[f'avg_{name}'] = stats[f'sum_{name}'] / stats[f'count_{name}']
+
 def populate_stats():
     logger.info("Populating stats...")
 
@@ -78,56 +131,17 @@ def populate_stats():
         logger.error(f"Invalid datetime format for last_event_datetime: {last_event_datetime}")
         last_event_datetime = "2025-01-01T00:00:00Z"
 
-    temperature_url = app_conf['urls']['temperature_events']
     params = {
         'start_timestamp': last_event_datetime,
         'end_timestamp': current_datetime
     }
 
-    logger.info(f"Querying temperature events with URL: {temperature_url} and params: {params}")
-
-    try:
-        temp_response = httpx.get(temperature_url, params=params)
-        logger.info(f"Final URL sent: {temp_response.request.url}")
-        temp_response.raise_for_status()
-
-        if temp_response.status_code == 200:
-            temp_events = temp_response.json()
-            logger.info(f"Received {len(temp_events)} temperature events.")
-            for event in temp_events:
-                temp_value = event['temperature']
-                stats['num_temperature_events'] += 1
-                stats['sum_temperature_value'] += temp_value
-                stats['count_temperature_value'] += 1
-                stats['max_temperature_value'] = max(stats['max_temperature_value'], temp_value)
-                stats['min_temperature_value'] = min(stats['min_temperature_value'], temp_value)
-            if stats['count_temperature_value'] > 0:
-                stats['avg_temperature_value'] = stats['sum_temperature_value'] / stats['count_temperature_value']
-        else:
-            logger.error(f"Failed to fetch temperature events. Status code: {temp_response.status_code}")
-    except Exception as e:
-        logger.error(f"Error querying temperature events: {e}")
-
-    motion_url = app_conf['urls']['motion_events']
     try:
-        motion_response = httpx.get(motion_url, params=params)
-        motion_response.raise_for_status()
-        if motion_response.status_code == 200:
-            motion_events = motion_response.json()
-            logger.info(f"Received {len(motion_events)} motion events.")
-            for event in motion_events:
-                motion_intensity = event['motion_intensity']
-                stats['num_motion_events'] += 1
-                stats['sum_motion_intensity'] += motion_intensity
-                stats['count_motion_intensity'] += 1
-                stats['max_motion_intensity'] = max(stats['max_motion_intensity'], motion_intensity)
-                stats['min_motion_intensity'] = min(stats['min_motion_intensity'], motion_intensity)
-            if stats['count_motion_intensity'] > 0:
-                stats['avg_motion_intensity'] = stats['sum_motion_intensity'] / stats['count_motion_intensity']
-        else:
-            logger.error(f"Failed to fetch motion events. Status code: {motion_response.status_code}")
+        aggregates = fetch_aggregates(params)
     except Exception as e:
-        logger.error(f"Error querying motion events: {e}")
+        logger.warning(f"Error querying event aggregates, downloading the events instead: {e}")
+        aggregates = download_aggregates(params)
+    add_aggregates(stats, aggregates)
 
     stats['last_event_datetime'] = current_datetime
 
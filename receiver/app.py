@@ -1,18 +1,32 @@
 import connexion
 import os
 import sys
+import fcntl
+import math
+import tempfile
 import json
 import httpx
 import time
 import yaml
 import logging
 import logging.config
+import log_setup
 from datetime import datetime
-from threading import Lock
+from jsonschema import Draft4Validator
+from threading import Thread, Lock
+from flask import Response
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 from connexion import NoContent
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import AbstractRequestBodyValidator, JSONResponseBodyValidator, VALIDATOR_MAP
 from pykafka import KafkaClient
+from producer import EventProducer, ProducerQueueFull
+from fast_validation import FastJSONRequestBodyValidator, compile_schema
+from rate_limit import RateLimiter
+from spool import Spool
+from trace_ids import SnowflakeGenerator, NODE_BITS
+import wire
 
 ENV = os.environ.get('ENV', 'dev')
 CONFIG_PATH = os.environ.get('CONFIG_PATH', '../config')
@@ -23,12 +37,150 @@ APP_CONF_FILE = os.path.join(FULL_CONFIG_PATH, 'receiver_app_conf.yml')
 
 with open(LOG_CONF_FILE, "r") as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.setup_logging(log_config)
 
 with open(APP_CONF_FILE, 'r') as f:
     app_config = yaml.safe_load(f.read())
 
 logger = logging.getLogger("basicLogger")
+# Per-event lines, sampled and formatted lazily (see receiver_log_conf.yml)
+event_logger = logging.getLogger("basicLogger.events")
+
+# json or binary, consumers accept both so this can be switched per replica
+MESSAGE_ENCODING = app_config['events'].get('encoding', wire.JSON)
+
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'receiver.yml')
+
+with open(SPEC_FILE, 'r') as f:
+    event_schemas = yaml.safe_load(f.read())['components']['schemas']
+
+# Batch items are validated one by one against the same schemas as the
+# single-event endpoints so one bad reading doesn't reject the whole batch
+EVENT_VALIDATORS = {
+    "temperature": Draft4Validator(event_schemas['TemperatureEvent']),
+    "motion": Draft4Validator(event_schemas['MotionEvent']),
+}
+
+# Precompiled request validation and no response validation on the ingest
+# routes, see fast_validation.py
+FAST_VALIDATION = app_config.get('validation', {}).get('fast_path', False)
+
+# Shared by all threads of a worker process, each worker has its own budget
+limit_conf = app_config.get('rate_limit', {})
+rate_limiter = None
+if limit_conf.get('enabled', False):
+    rate_limiter = RateLimiter(
+        limit_conf.get('device_rate'),
+        limit_conf.get('device_burst'),
+        limit_conf.get('global_rate'),
+        limit_conf.get('global_burst'),
+        limit_conf.get('max_devices', 10000)
+    )
+
+# Precompiled checks for batch items, only built when the fast path is on
+EVENT_CHECKS = {
+    event_type: compile_schema(event_schemas[name])
+    for event_type, name in (("temperature", "TemperatureEvent"), ("motion", "MotionEvent"))
+} if FAST_VALIDATION else {}
+
+def claim_slot(directory, limit=None):
+    """
+    Claims the lowest free slot in a directory of lock files, returning it
+    with its lock file. The lock is held for the life of the process, so a
+    slot is freed when its process exits and the next process to start
+    takes it over.
+    """
+    os.makedirs(directory, exist_ok=True)
+    slot = 0
+    while limit is None or slot < limit:
+        lock_file = open(os.path.join(directory, f"{slot}.lock"), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot, lock_file
+        except BlockingIOError:
+            lock_file.close()
+            slot += 1
+    raise RuntimeError(f"All {limit} slots in {directory} are taken")
+
+def claim_worker_slot():
+    """
+    Claims the lowest free worker slot on this host, so each worker of a
+    replica gets its own trace IDs and spool directory, and a restarted
+    worker picks up the spool its predecessor left behind.
+    """
+    return claim_slot(os.path.join(tempfile.gettempdir(), 'receiver-workers'))
+
+def max_node_id():
+    return (1 << (NODE_BITS - app_config.get('trace_ids', {}).get('worker_bits', 3))) - 1
+
+def configured_node_id():
+    """
+    Node ID of this receiver replica, from RECEIVER_NODE_ID or the config,
+    or None if its workers claim one from trace_ids.node_lock_directory.
+    There is no other default, since two replicas sharing one would hand
+    out the same trace IDs.
+    """
+    trace_conf = app_config.get('trace_ids', {})
+    node_id = os.environ.get('RECEIVER_NODE_ID', trace_conf.get('node_id'))
+    if node_id is None:
+        if trace_conf.get('node_lock_directory'):
+            return None
+        raise ValueError("No node ID configured, set RECEIVER_NODE_ID, trace_ids.node_id "
+                         "or trace_ids.node_lock_directory")
+    node_id = int(node_id)
+    if not 0 <= node_id <= max_node_id():
+        raise ValueError(f"Node ID must be between 0 and {max_node_id()}, got {node_id}")
+    return node_id
+
+# Checked at startup rather than by the first request
+NODE_ID = configured_node_id()
+
+def claim_node_id():
+    """
+    Claims the lowest free node ID in trace_ids.node_lock_directory, which
+    all replicas share, so scaled replicas need no configuration. The
+    worker holds the whole node ID, and a worker taking over a freed one
+    drains the spool left under it.
+    """
+    return claim_slot(app_config['trace_ids']['node_lock_directory'], max_node_id() + 1)
+
+def create_trace_id_generator(node_id, slot):
+    """ Trace ID generator for this worker, the node ID plus the worker slot """
+    worker_bits = app_config.get('trace_ids', {}).get('worker_bits', 3)
+    if slot >= 1 << worker_bits:
+        raise ValueError(f"Worker slot {slot} does not fit in trace_ids.worker_bits ({worker_bits})")
+    return SnowflakeGenerator((node_id << worker_bits) | slot)
+
+def create_spool(node_id, slot):
+    """ Opens this worker's local spool, or returns None if spooling is disabled """
+    spool_conf = app_config.get('spool', {})
+    if not spool_conf.get('enabled', False):
+        return None
+
+    # Each receiver replica and worker keeps its own spool directory, keyed
+    # by node ID so a recreated container drains what its predecessor left
+    directory = os.path.join(spool_conf['directory'], f"node-{node_id}", str(slot))
+    return Spool(
+        directory,
+        segment_size=spool_conf.get('segment_size_mb', 16) * 1024 * 1024,
+        fsync=spool_conf.get('fsync', 'interval'),
+        fsync_interval_ms=spool_conf.get('fsync_interval_ms', 200)
+    )
+
+trace_ids, spool = None, None
+client, topic, producer = None, None, None
+worker_pid, worker_slot_file = None, None
+worker_lock = Lock()
+
+def log_delivery(value, exc):
+    """ Delivery report callback for messages sent to Kafka """
+    if exc is None:
+        return
+    if spool is None:
+        logger.error(f"Failed to deliver Kafka message: {str(exc)}")
+        return
+    logger.error(f"Failed to deliver Kafka message, spooling it: {str(exc)}")
+    spool.append(value)
 
 # Add retry logic for Kafka connection
 def connect_to_kafka():
@@ -41,8 +193,8 @@ def connect_to_kafka():
             logger.info(f"Connecting to Kafka (Attempt {retry_count+1}/{max_retries})...")
             client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
             topic = client.topics[str.encode(app_config['events']['topic'])]
-            producer = topic.get_sync_producer()
-            logger.info("Connected to Kafka!")
+            producer = EventProducer(topic, app_config['producer'], on_delivery=log_delivery)
+            logger.info(f"Connected to Kafka! Producer mode: {producer.mode}")
             kafka_connected = True
             return client, topic, producer
         except Exception as e:
@@ -55,14 +207,93 @@ def connect_to_kafka():
                 logger.error("Failed to connect to Kafka after maximum retries")
                 raise Exception(f"Failed to connect to Kafka after {max_retries} attempts: {str(e)}")
 
-# Establish connection to Kafka with retries
-client, topic, producer = connect_to_kafka()
+def drain_spool():
+    """ Replays spooled messages to Kafka in order whenever Kafka is reachable """
+    spool_conf = app_config['spool']
+    while True:
+        spool.sync()
+        if spool.is_empty():
+            time.sleep(0.1)
+            continue
 
-def log_event(event_type, event_body):
-    """ Logs the event to Kafka """
-    trace_id = time.time_ns()
-    logger.info(f"Received event {event_type} with a trace ID of {trace_id}")
+        records, position = spool.read(spool_conf.get('drain_batch_size', 100))
+        keyed = [(value, partition_key(wire.decode(value)["payload"])) for value in records]
+        errors = producer.send_all(keyed, app_config['batch']['delivery_timeout_s'])
+        delivered = 0
+        for error in errors:
+            if error is not None:
+                break
+            delivered += 1
+
+        if delivered < len(records):
+            # Only the delivered prefix is committed so the order is kept
+            logger.warning(f"Kafka unavailable, {len(spool)} messages left in spool: {str(errors[delivered])}")
+            producer.healthy = False
+            if delivered == 0:
+                time.sleep(spool_conf.get('retry_interval_s', 5))
+                continue
+            records, position = spool.read(delivered)
+
+        spool.commit(position, len(records))
+        logger.info(f"Replayed {len(records)} spooled messages to Kafka, {len(spool)} left")
+
+def run_kafka():
+    """ Connects to Kafka in the background, then keeps draining the spool """
+    global client, topic, producer
+    while producer is None:
+        try:
+            client, topic, producer = connect_to_kafka()
+        except Exception as e:
+            logger.error(f"Kafka still unavailable, events are being spooled: {str(e)}")
+    drain_spool()
+
+def kafka_ready():
+    """ True when an event can go straight to Kafka without overtaking spooled ones """
+    return producer is not None and producer.healthy and (spool is None or spool.is_empty())
+
+def start_worker():
+    """
+    Sets up this process's trace IDs, spool and Kafka producer. This runs on
+    first use instead of at import, so every forked worker gets its own.
+    """
+    global trace_ids, spool, client, topic, producer, worker_pid, worker_slot_file
+    if worker_pid == os.getpid():
+        return
+
+    with worker_lock:
+        if worker_pid == os.getpid():
+            return
+
+        if NODE_ID is None:
+            node_id, worker_slot_file = claim_node_id()
+            slot = 0
+        else:
+            node_id = NODE_ID
+            slot, worker_slot_file = claim_worker_slot()
+        logger.info(f"Starting receiver worker {slot} of node {node_id} (pid {os.getpid()})")
+        trace_ids = create_trace_id_generator(node_id, slot)
+        spool = create_spool(node_id, slot)
+        client, topic, producer = None, None, None
 
+        # With a spool the worker accepts events right away and connects in
+        # the background, otherwise it waits for Kafka as before
+        if spool is not None:
+            Thread(target=run_kafka, daemon=True).start()
+        else:
+            client, topic, producer = connect_to_kafka()
+        worker_pid = os.getpid()
+
+def stop_worker():
+    """ Flushes this worker's producer on shutdown """
+    if worker_pid == os.getpid() and producer is not None:
+        producer.stop()
+
+def partition_key(event_body):
+    """ Kafka partition key, keeps each device's events in order on one partition """
+    return event_body["device_id"].encode('utf-8')
+
+def build_message(event_type, event_body, trace_id):
+    """ Builds the Kafka message for an event, encoded in the configured wire format """
     if event_type == "temperature":
         event_data = {
             "trace_id": trace_id,
@@ -84,10 +315,50 @@ def log_event(event_type, event_body):
         "payload": event_data
     }
 
-    msg_str = json.dumps(msg)
-    logger.info(f"Sending message to Kafka: {msg_str}")
-    producer.produce(msg_str.encode('utf-8'))
-    logger.info(f"Produced Kafka message for event {event_type} with trace ID: {trace_id}")
+    return wire.encode(msg, MESSAGE_ENCODING)
+
+def admit(event_body):
+    """ Returns 0 if the event's device is within its rate limit, or else the seconds to wait """
+    if rate_limiter is None:
+        return 0
+    return rate_limiter.acquire(event_body["device_id"])
+
+def retry_after(wait):
+    """ Retry-After header for a wait in seconds, rounded up to whole seconds """
+    return {"Retry-After": str(max(1, math.ceil(wait)))}
+
+def log_event(event_type, event_body):
+    """ Logs the event to Kafka """
+    wait = admit(event_body)
+    if wait:
+        event_logger.warning("Rate limited event %s from device %s", event_type, event_body["device_id"])
+        return {"message": "Too many events, retry later"}, 429, retry_after(wait)
+
+    start_worker()
+    trace_id = trace_ids.next_id()
+    event_logger.info("Received event %s with a trace ID of %s", event_type, trace_id)
+
+    value = build_message(event_type, event_body, trace_id)
+
+    if spool is not None and not kafka_ready():
+        spool.append(value)
+        event_logger.info("Spooled event %s with trace ID %s, %s messages waiting for Kafka",
+                          event_type, trace_id, len(spool))
+        return NoContent, 201
+
+    event_logger.debug("Sending message to Kafka: %r", value)
+    try:
+        producer.send(value, partition_key(event_body))
+    except ProducerQueueFull as e:
+        logger.warning(f"Rejected event with trace ID {trace_id}: {str(e)}")
+        return {"message": "Receiver is busy, retry later"}, 503, {"Retry-After": str(producer.retry_after)}
+    except Exception as e:
+        if spool is None:
+            raise
+        # The delivery callback has already spooled the message
+        logger.warning(f"Kafka send failed for trace ID {trace_id}: {str(e)}")
+        return NoContent, 201
+    event_logger.info("Produced Kafka message for event %s with trace ID: %s", event_type, trace_id)
 
     return NoContent, 201
 
@@ -97,32 +368,204 @@ def postTemperatureEvent(body):
 def postMotionEvent(body):
     return log_event("motion", body)
 
-def getTemperatureEvents(start_timestamp, end_timestamp):
-    STORAGE_URL = app_config["events"]["temperature"]["url"]
-    params = {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp}
-    try:
-        response = httpx.get(STORAGE_URL, params=params)
-        if response.status_code == 200:
-            return response.json(), 200
+def parse_batch(body):
+    """ Splits a JSON array or NDJSON request body into a list of events """
+    if isinstance(body, list):
+        return body
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+
+    events = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            events.append(None)
+    return events
+
+def validate_batch_event(event):
+    """ Returns an error message for an invalid batch item, or None if it is valid """
+    if not isinstance(event, dict):
+        return "Item is not a valid JSON object"
+
+    # A list or object would not even be hashable
+    if not isinstance(event.get("type"), str):
+        return "Unknown event type"
+    validator = EVENT_VALIDATORS.get(event["type"])
+    if validator is None:
+        return f"'type' must be one of {list(EVENT_VALIDATORS)}"
+
+    is_valid = EVENT_CHECKS.get(event["type"])
+    if is_valid is not None and is_valid(event):
+        return None
+    for error in validator.iter_errors(event):
+        return error.message
+    return None
+
+def postEventsBatch(body):
+    """ Validates a batch of events and sends the valid ones to Kafka together """
+    start_worker()
+    events = parse_batch(body)
+    max_events = app_config['batch']['max_events']
+
+    if len(events) == 0:
+        return {"message": "Batch is empty"}, 400
+    if len(events) > max_events:
+        return {"message": f"Batch exceeds the maximum of {max_events} events"}, 413
+
+    logger.info(f"Received batch of {len(events)} events")
+
+    results = []
+    messages = []
+    limited_wait = 0
+    for index, event in enumerate(events):
+        error = validate_batch_event(event)
+        if error is not None:
+            results.append({"index": index, "status": 400, "error": error})
+            continue
+
+        wait = admit(event)
+        if wait:
+            results.append({"index": index, "status": 429, "error": "Too many events, retry later"})
+            limited_wait = max(limited_wait, wait)
+            continue
+
+        trace_id = trace_ids.next_id()
+        value = build_message(event["type"], event, trace_id)
+        result = {"index": index, "status": 201, "trace_id": trace_id}
+        results.append(result)
+        messages.append((value, result))
+
+    keyed = [(value, partition_key(events[result["index"]])) for value, result in messages]
+    if spool is not None and not kafka_ready():
+        errors = [ConnectionError("Kafka is unavailable")] * len(keyed)
+    else:
+        errors = producer.send_all(keyed, app_config['batch']['delivery_timeout_s'])
+
+    for (value, result), error in zip(messages, errors):
+        if error is None:
+            continue
+        if isinstance(error, ProducerQueueFull):
+            result["status"] = 503
+            result["error"] = "Receiver is busy, retry later"
+        elif spool is not None:
+            spool.append(value)
+        elif isinstance(error, TimeoutError):
+            result["status"] = 504
+            result["error"] = "Delivery was not confirmed in time"
         else:
-            return {"error": "Failed to retrieve temperature events"}, response.status_code
-    except httpx.RequestError as e:
-        logger.error(f"Failed to fetch temperature events: {e}")
-        return {"error": f"Request failed: {e}"}, 500
+            logger.error(f"Failed to deliver batch event with trace ID {result['trace_id']}: {str(error)}")
+            result["status"] = 503
+            result["error"] = "Failed to deliver event"
 
-def getMotionEvents(start_timestamp, end_timestamp):
-    STORAGE_URL = app_config["events"]["motion"]["url"]
+    accepted = sum(1 for result in results if result["status"] == 201)
+    logger.info(f"Produced {accepted}/{len(events)} events from batch")
+
+    response = {
+        "accepted": accepted,
+        "rejected": len(events) - accepted,
+        "results": results
+    }
+    if accepted == 0 and any(result["status"] == 503 for result in results):
+        return response, 503, {"Retry-After": str(producer.retry_after)}
+    if accepted == 0 and limited_wait:
+        logger.warning(f"Rate limited all valid events of a batch of {len(events)}")
+        return response, 429, retry_after(limited_wait)
+    if all(result["status"] == 400 for result in results):
+        return response, 400
+    return response, 201 if accepted == len(events) else 207
+
+def storage_client_options():
+    """ Pool limits and timeouts for clients of the storage service """
+    client_conf = app_config.get('storage_client', {})
+    return {
+        "limits": httpx.Limits(
+            max_connections=client_conf.get('max_connections', 20),
+            max_keepalive_connections=client_conf.get('max_keepalive_connections', 10),
+            keepalive_expiry=client_conf.get('keepalive_expiry_s', 30)
+        ),
+        "timeout": httpx.Timeout(
+            client_conf.get('read_timeout_s', 30),
+            connect=client_conf.get('connect_timeout_s', 2)
+        )
+    }
+
+# Shared keep-alive connection pool for queries to the storage service
+storage_client = httpx.Client(**storage_client_options())
+
+def stream_storage_events(event_type, start_timestamp, end_timestamp):
+    """
+    Forwards storage's response for an event query chunk by chunk, without
+    parsing it, so memory use doesn't depend on the size of the time range
+    """
+    STORAGE_URL = app_config["events"][event_type]["url"]
     params = {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp}
     try:
-        response = httpx.get(STORAGE_URL, params=params)
-        if response.status_code == 200:
-            return response.json(), 200
-        else:
-            return {"error": "Failed to retrieve motion events"}, response.status_code
+        request = storage_client.build_request("GET", STORAGE_URL, params=params)
+        response = storage_client.send(request, stream=True)
     except httpx.RequestError as e:
-        logger.error(f"Failed to fetch motion events: {e}")
+        logger.error(f"Failed to fetch {event_type} events: {e}")
         return {"error": f"Request failed: {e}"}, 500
 
+    if response.status_code != 200:
+        response.close()
+        return {"error": f"Failed to retrieve {event_type} events"}, response.status_code
+
+    chunk_size = app_config.get('storage_client', {}).get('chunk_size', 65536)
+
+    def body():
+        try:
+            yield from response.iter_bytes(chunk_size)
+        except httpx.HTTPError as e:
+            logger.error(f"Storage stream for {event_type} events broke off: {e}")
+        finally:
+            response.close()
+
+    content_type = response.headers.get('content-type', 'application/json')
+    return Response(body(), status=200, content_type=content_type)
+
+def getTemperatureEvents(start_timestamp, end_timestamp):
+    return stream_storage_events("temperature", start_timestamp, end_timestamp)
+
+def getMotionEvents(start_timestamp, end_timestamp):
+    return stream_storage_events("motion", start_timestamp, end_timestamp)
+
+class NDJSONRequestBodyValidator(AbstractRequestBodyValidator):
+    """ Passes NDJSON bodies through untouched, each line is validated by the handler """
+
+    async def _parse(self, stream, scope):
+        async for _ in stream:
+            pass
+
+class PassThroughResponseValidator(JSONResponseBodyValidator):
+    """ JSON response validator that operations can opt out of with x-skip-response-validation """
+
+    def wrap_send(self, send):
+        # Validation would buffer the whole body, which defeats streaming
+        if self._schema.get('x-skip-response-validation'):
+            return send
+        # With the fast path the ingest routes answer with unvalidated responses
+        if FAST_VALIDATION and self._scope["method"] == "POST":
+            return send
+        return super().wrap_send(send)
+
+# Connexion's "*/*json" validator would otherwise try to parse NDJSON as one document
+validator_map = {
+    **VALIDATOR_MAP,
+    "body": MediaTypeDict({
+        **VALIDATOR_MAP["body"],
+        **({"*/*json": FastJSONRequestBodyValidator} if FAST_VALIDATION else {}),
+        "application/x-ndjson": NDJSONRequestBodyValidator,
+    }),
+    "response": MediaTypeDict({
+        **VALIDATOR_MAP["response"],
+        "*/*json": PassThroughResponseValidator,
+    }),
+}
+
 app = connexion.FlaskApp(__name__, specification_dir='.')
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
@@ -133,8 +576,9 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_methods=["*"],
         allow_headers=["*"],
     )
-app.add_api("receiver.yml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app.add_api("receiver.yml", base_path="/receiver", strict_validation=True, validate_responses=True, validator_map=validator_map)
 
 if __name__ == "__main__":
     logger.info("Starting Receiver Service")
+    start_worker()
     app.run(port=8081, host="0.0.0.0")
\ No newline at end of file
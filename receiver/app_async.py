@@ -0,0 +1,106 @@
+"""
+ASGI variant of the receiver for running several worker processes, e.g.
+
+    uvicorn app_async:app --host 0.0.0.0 --port 8081 --workers 4
+
+or under gunicorn with uvicorn.workers.UvicornWorker. Every worker sets up
+its own trace IDs, spool and Kafka producer when it starts, after the fork.
+"""
+import os
+import httpx
+import connexion
+import uvicorn
+from contextlib import asynccontextmanager
+from connexion.middleware import MiddlewarePosition
+from connexion.resolver import Resolver
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
+import app as receiver
+
+logger = receiver.logger
+storage_client = None
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Starts this worker's producer and storage client, and flushes them on shutdown """
+    global storage_client
+    await run_in_threadpool(receiver.start_worker)
+    storage_client = httpx.AsyncClient(**receiver.storage_client_options())
+    yield
+    await storage_client.aclose()
+    await run_in_threadpool(receiver.stop_worker)
+
+async def log_event(event_type, body):
+    """ Queues the event on the event loop when that can't block, otherwise uses the thread pool """
+    producer = receiver.producer
+    if producer is not None and producer.mode == 'async' and receiver.kafka_ready():
+        return receiver.log_event(event_type, body)
+    return await run_in_threadpool(receiver.log_event, event_type, body)
+
+async def postTemperatureEvent(body):
+    return await log_event("temperature", body)
+
+async def postMotionEvent(body):
+    return await log_event("motion", body)
+
+async def postEventsBatch(body):
+    # Waits for the delivery report of every item, so it runs off the event loop
+    return await run_in_threadpool(receiver.postEventsBatch, body)
+
+async def stream_storage_events(event_type, start_timestamp, end_timestamp):
+    """ Async version of receiver.stream_storage_events """
+    STORAGE_URL = receiver.app_config["events"][event_type]["url"]
+    params = {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp}
+    try:
+        request = storage_client.build_request("GET", STORAGE_URL, params=params)
+        response = await storage_client.send(request, stream=True)
+    except httpx.RequestError as e:
+        logger.error(f"Failed to fetch {event_type} events: {e}")
+        return {"error": f"Request failed: {e}"}, 500
+
+    if response.status_code != 200:
+        await response.aclose()
+        return {"error": f"Failed to retrieve {event_type} events"}, response.status_code
+
+    chunk_size = receiver.app_config.get('storage_client', {}).get('chunk_size', 65536)
+
+    async def body():
+        try:
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+        except httpx.HTTPError as e:
+            logger.error(f"Storage stream for {event_type} events broke off: {e}")
+        finally:
+            await response.aclose()
+
+    content_type = response.headers.get('content-type', 'application/json')
+    return StreamingResponse(body(), status_code=200, media_type=content_type)
+
+async def getTemperatureEvents(start_timestamp, end_timestamp):
+    return await stream_storage_events("temperature", start_timestamp, end_timestamp)
+
+async def getMotionEvents(start_timestamp, end_timestamp):
+    return await stream_storage_events("motion", start_timestamp, end_timestamp)
+
+def resolve_handler(operation_id):
+    """ Maps the spec's app.<handler> operation IDs to the handlers in this module """
+    return globals()[operation_id.rsplit('.', 1)[-1]]
+
+app = connexion.AsyncApp(__name__, specification_dir='.', lifespan=lifespan)
+if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
+    app.add_middleware(
+        CORSMiddleware,
+        position=MiddlewarePosition.BEFORE_EXCEPTION,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+app.add_api("receiver.yml", base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map=receiver.validator_map, resolver=Resolver(resolve_handler))
+
+if __name__ == "__main__":
+    workers = receiver.app_config.get('server', {}).get('workers', 1)
+    logger.info(f"Starting Receiver Service with {workers} ASGI workers")
+    uvicorn.run("app_async:app", port=8081, host="0.0.0.0", workers=workers)
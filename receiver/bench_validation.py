@@ -0,0 +1,39 @@
+""" Compares per-request body validation time of connexion's validator and the precompiled fast path """
+import timeit
+import yaml
+from connexion.validators import JSONRequestBodyValidator
+from fast_validation import FastJSONRequestBodyValidator
+
+N = 20000
+
+with open('receiver.yml', 'r') as f:
+    schemas = yaml.safe_load(f.read())['components']['schemas']
+
+BODIES = {
+    "temperature": (schemas['TemperatureEvent'], {
+        "device_id": "thermostat-001",
+        "temperature": 22.5,
+        "timestamp": "2025-01-09T10:30:00Z",
+        "event_type": "temperature",
+    }),
+    "motion": (schemas['MotionEvent'], {
+        "device_id": "motion-sensor-007",
+        "room": "Living Room",
+        "timestamp": "2025-01-09T10:45:00Z",
+        "motion_intensity": 75,
+    }),
+}
+
+
+def validate(validator_class, schema, body):
+    # Connexion builds a new body validator for every request
+    validator = validator_class(schema=schema, encoding='utf-8', strict_validation=True)
+    validator._validate(body)
+
+
+if __name__ == "__main__":
+    print(f"{'event':<12}{'jsonschema us':>15}{'fast path us':>15}{'speedup':>10}")
+    for name, (schema, body) in BODIES.items():
+        slow = timeit.timeit(lambda: validate(JSONRequestBodyValidator, schema, body), number=N)
+        fast = timeit.timeit(lambda: validate(FastJSONRequestBodyValidator, schema, body), number=N)
+        print(f"{name:<12}{slow / N * 1e6:>15.2f}{fast / N * 1e6:>15.2f}{slow / fast:>9.1f}x")
@@ -0,0 +1,40 @@
+""" Compares encode/decode time and message size of the JSON and binary wire formats """
+import time
+import timeit
+import wire
+
+N = 100000
+
+MESSAGES = {
+    "temperature": {
+        "type": "temperature",
+        "datetime": "2025-01-09T10:30:00",
+        "payload": {
+            "trace_id": time.time_ns(),
+            "device_id": "thermostat-001",
+            "temperature": 22.5,
+            "event_type": "temperature",
+        }
+    },
+    "motion": {
+        "type": "motion",
+        "datetime": "2025-01-09T10:45:00",
+        "payload": {
+            "trace_id": time.time_ns(),
+            "device_id": "motion-sensor-007",
+            "room": "Living Room",
+            "motion_intensity": 75,
+        }
+    },
+}
+
+if __name__ == "__main__":
+    print(f"{'event':<12}{'format':<8}{'bytes':>7}{'encode us':>12}{'decode us':>12}")
+    for name, msg in MESSAGES.items():
+        for encoding in (wire.JSON, wire.BINARY):
+            data = wire.encode(msg, encoding)
+            assert wire.decode(data) == msg
+            encode_time = timeit.timeit(lambda: wire.encode(msg, encoding), number=N)
+            decode_time = timeit.timeit(lambda: wire.decode(data), number=N)
+            print(f"{name:<12}{encoding:<8}{len(data):>7}"
+                  f"{encode_time / N * 1e6:>12.2f}{decode_time / N * 1e6:>12.2f}")
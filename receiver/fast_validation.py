@@ -0,0 +1,84 @@
+from jsonschema import Draft4Validator
+from connexion.validators import JSONRequestBodyValidator
+
+# Precompiled checks for the event schemas. A check only answers "this body
+# is definitely valid"; anything it can't vouch for goes through the regular
+# jsonschema validator, so rejected requests get exactly the same error
+# messages as before and valid ones skip building a validator per request.
+
+# Keywords that only describe a property and never fail validation
+ANNOTATIONS = {'description', 'example', 'title', 'x-nullable', 'nullable'}
+
+# Draft 4 type checks, bools are neither numbers nor integers
+TYPE_CHECKS = {
+    'string': lambda value: type(value) is str,
+    'number': lambda value: type(value) in (int, float),
+    'integer': lambda value: type(value) is int,
+    'boolean': lambda value: type(value) is bool,
+}
+
+FORMAT_CHECKER = Draft4Validator.FORMAT_CHECKER
+
+
+def compile_schema(schema):
+    """
+    Compiles a flat object schema into a function returning True for bodies
+    that are valid. Returns None if the schema uses anything beyond
+    type/required/properties/format, those keep the full validator.
+    """
+    if schema.get('type') != 'object':
+        return None
+    if set(schema) - ANNOTATIONS - {'type', 'required', 'properties'}:
+        return None
+
+    required = tuple(schema.get('required', ()))
+    checks = []
+    for name, prop in schema.get('properties', {}).items():
+        if set(prop) - ANNOTATIONS - {'type', 'format'}:
+            return None
+        type_check = TYPE_CHECKS.get(prop.get('type'))
+        if type_check is None:
+            return None
+        checks.append((name, type_check, prop.get('format')))
+    checks = tuple(checks)
+
+    def is_valid(body):
+        if type(body) is not dict:
+            return False
+        for name in required:
+            if name not in body:
+                return False
+        for name, type_check, fmt in checks:
+            if name in body:
+                value = body[name]
+                if not type_check(value):
+                    return False
+                if fmt is not None and not FORMAT_CHECKER.conforms(value, fmt):
+                    return False
+        return True
+
+    return is_valid
+
+
+# Connexion creates a body validator per request, compiled checks are kept
+# per schema object so each operation is compiled once
+_compiled = {}
+
+
+def compiled_check(schema):
+    """ Returns the compiled check for a schema, or None if it can't be compiled """
+    key = id(schema)
+    if key not in _compiled:
+        # The schema is kept alongside so its id can't be reused
+        _compiled[key] = (schema, compile_schema(schema))
+    return _compiled[key][1]
+
+
+class FastJSONRequestBodyValidator(JSONRequestBodyValidator):
+    """ JSON body validator that tries the precompiled check before jsonschema """
+
+    def _validate(self, body):
+        is_valid = compiled_check(self._schema)
+        if is_valid is not None and is_valid(body):
+            return None
+        return super()._validate(body)
@@ -0,0 +1,72 @@
+import atexit
+import random
+import logging
+import logging.config
+import logging.handlers
+from queue import Queue, Full
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through roughly `rate` of the records logged on a logger, for
+    per-event lines on hot paths. Warnings and errors always pass.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that drops records instead of blocking when the queue is full """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records stay unformatted here, the listener thread formats them
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def setup_logging(log_config):
+    """
+    Applies a *_log_conf.yml config. If its queue section is enabled, the
+    configured handlers are moved behind bounded queues and written by
+    background listener threads, so logging calls never wait on I/O.
+    Returns the listeners that were started.
+    """
+    logging.config.dictConfig(log_config)
+
+    queue_conf = log_config.get('queue', {})
+    if not queue_conf.get('enabled', False):
+        return []
+
+    loggers = [logging.getLogger(name) for name in log_config.get('loggers', {})]
+    loggers.append(logging.getLogger())
+
+    # Loggers with the same handlers share one queue and listener thread
+    queue_handlers = {}
+    listeners = []
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        key = tuple(id(handler) for handler in logger.handlers)
+        if key not in queue_handlers:
+            queue = Queue(maxsize=queue_conf.get('max_size', 10000))
+            listener = logging.handlers.QueueListener(queue, *logger.handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            listeners.append(listener)
+            queue_handlers[key] = DroppingQueueHandler(queue)
+        logger.handlers = [queue_handlers[key]]
+    return listeners
@@ -0,0 +1,164 @@
+import logging
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+from pykafka.partitioners import hashing_partitioner
+
+logger = logging.getLogger("basicLogger")
+
+
+class ProducerQueueFull(Exception):
+    """ Raised when the async producer has no room left for another message """
+
+
+class EventProducer:
+    """
+    Sends event messages to a Kafka topic.
+
+    In "sync" mode every send waits for the broker to acknowledge the message.
+    In "async" mode messages are put on a bounded in-memory queue and a
+    background thread hands them to a batching pykafka producer, so requests
+    return as soon as the message is queued. Delivery results are passed to
+    the per-message callback, or to on_delivery for messages sent without one.
+    healthy is False while the last delivery attempt failed.
+
+    Messages are partitioned by their key, so all events for one key stay in
+    order on one partition.
+    """
+
+    def __init__(self, topic, conf, on_delivery=None):
+        self.mode = conf.get('mode', 'sync')
+        self.retry_after = conf.get('retry_after_s', 1)
+        self.on_delivery = on_delivery
+        self.delivered = 0
+        self.failed = 0
+        self.healthy = True
+
+        if self.mode == 'async':
+            self._producer = topic.get_producer(
+                partitioner=hashing_partitioner,
+                delivery_reports=True,
+                linger_ms=conf.get('linger_ms', 5),
+                min_queued_messages=conf.get('max_batch_size', 500),
+                max_queued_messages=conf.get('max_queued_messages', 10000)
+            )
+            self._queue = Queue(maxsize=conf.get('max_queued_messages', 10000))
+            self._callbacks = {}
+            self._running = True
+            self._thread = Thread(target=self._dispatch, daemon=True)
+            self._thread.start()
+        else:
+            self._producer = topic.get_sync_producer(partitioner=hashing_partitioner)
+
+    def send(self, value, key=None, callback=None):
+        """
+        Sends one message. Raises ProducerQueueFull in async mode when the
+        queue is full, the caller should ask the client to retry later.
+        """
+        if self.mode != 'async':
+            try:
+                self._producer.produce(value, partition_key=key)
+            except Exception as e:
+                self._report(value, e, callback)
+                raise
+            self._report(value, None, callback)
+            return
+
+        try:
+            self._queue.put_nowait((value, key, callback))
+        except Full:
+            raise ProducerQueueFull(f"Producer queue is full ({self._queue.maxsize} messages)")
+
+    def send_all(self, messages, timeout):
+        """
+        Sends several (value, key) messages and waits for their delivery
+        reports. Returns one entry per message: None if it was delivered, otherwise the
+        exception that stopped it (ProducerQueueFull, the delivery error, or
+        TimeoutError if no report arrived in time).
+        """
+        results = [TimeoutError("Delivery was not confirmed in time")] * len(messages)
+        state = {"remaining": len(messages), "closed": False}
+        done = Event()
+        lock = Lock()
+        if not messages:
+            return results
+
+        def report(index, exc):
+            with lock:
+                if state["closed"]:
+                    return
+                results[index] = exc
+                state["remaining"] -= 1
+                if state["remaining"] == 0:
+                    done.set()
+
+        for index, (value, key) in enumerate(messages):
+            try:
+                self.send(value, key, callback=lambda value, exc, index=index: report(index, exc))
+            except ProducerQueueFull as e:
+                report(index, e)
+            except Exception:
+                # Sync mode has already reported the failure through the callback
+                pass
+
+        done.wait(timeout)
+        with lock:
+            state["closed"] = True
+            return list(results)
+
+    def queue_depth(self):
+        """ Number of messages waiting to be handed to Kafka """
+        return self._queue.qsize() if self.mode == 'async' else 0
+
+    def stop(self):
+        """ Flushes queued messages and stops the producer """
+        if self.mode == 'async':
+            self._running = False
+            self._thread.join()
+        else:
+            self._producer.stop()
+
+    def _dispatch(self):
+        # pykafka keeps delivery reports per producing thread, so every
+        # message is produced from this thread and its reports drained here
+        while self._running or not self._queue.empty():
+            try:
+                value, key, callback = self._queue.get(timeout=0.05)
+            except Empty:
+                self._drain_reports()
+                continue
+
+            try:
+                msg = self._producer.produce(value, partition_key=key)
+                self._callbacks[id(msg)] = (msg, callback)
+            except Exception as e:
+                self._report(value, e, callback)
+
+            self._drain_reports()
+
+        self._producer.stop()
+        self._drain_reports()
+
+    def _drain_reports(self):
+        while True:
+            try:
+                msg, exc = self._producer.get_delivery_report(block=False)
+            except Empty:
+                return
+            _, callback = self._callbacks.pop(id(msg), (msg, None))
+            self._report(msg.value, exc, callback)
+
+    def _report(self, value, exc, callback):
+        if exc is None:
+            self.delivered += 1
+        else:
+            self.failed += 1
+        self.healthy = exc is None
+
+        handler = callback or self.on_delivery
+        if handler is None:
+            return
+        try:
+            handler(value, exc)
+        except Exception as e:
+            logger.error(f"Delivery callback failed: {str(e)}")
+
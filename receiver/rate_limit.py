@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TokenBucket:
+    """ Holds up to `burst` tokens, refilled at `rate` tokens per second """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """ Seconds until a token is available, 0 if one is available now """
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Per-device and global token buckets. An event is only admitted when both
+    its device's bucket and the global bucket have a token, so a rejected
+    event doesn't use up anyone's budget. Device buckets are kept in LRU
+    order and the least recently seen devices are dropped past max_devices;
+    an evicted device simply starts again with a full bucket.
+
+    A rate of 0 or None turns that limit off.
+    """
+
+    def __init__(self, device_rate, device_burst, global_rate, global_burst, max_devices=10000):
+        self.device_rate = device_rate
+        self.device_burst = device_burst or max(device_rate or 0, 1)
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+        self.global_bucket = None
+        if global_rate:
+            self.global_bucket = TokenBucket(global_rate, global_burst or max(global_rate, 1), time.monotonic())
+        self.admitted = 0
+        self.rejected = 0
+        self._lock = Lock()
+
+    def _device_bucket(self, device_id, now):
+        bucket = self.devices.get(device_id)
+        if bucket is None:
+            bucket = TokenBucket(self.device_rate, self.device_burst, now)
+            self.devices[device_id] = bucket
+            if len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(device_id)
+            bucket.refill(now)
+        return bucket
+
+    def acquire(self, device_id):
+        """ Takes a token for the device, returns 0 if admitted or else the seconds to wait """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            if self.device_rate:
+                buckets.append(self._device_bucket(device_id, now))
+            if self.global_bucket is not None:
+                self.global_bucket.refill(now)
+                buckets.append(self.global_bucket)
+
+            wait = max((bucket.wait_time() for bucket in buckets), default=0.0)
+            if wait > 0:
+                self.rejected += 1
+                return wait
+
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.admitted += 1
+            return 0.0
@@ -0,0 +1,204 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+from threading import Lock
+
+logger = logging.getLogger("basicLogger")
+
+# Every record is a 4 byte length and a 4 byte CRC32 followed by the message
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+
+
+class Spool:
+    """
+    Append-only queue of messages on local disk.
+
+    Messages are written into fixed-size, memory-mapped segment files. A
+    zero length header marks the end of the written part of a segment, so a
+    segment can be recovered after a crash by scanning it. The read position
+    is kept in a cursor file and segments behind it are deleted.
+
+    fsync controls when written pages are flushed to disk: "always" after
+    every append, "interval" at most every fsync_interval_ms, "never" leaves
+    it to the OS.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, fsync='interval', fsync_interval_ms=200):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+        self._lock = Lock()
+        self._maps = {}
+        self._dirty = False
+        self._last_sync = time.monotonic()
+        self._cursor_file = os.path.join(directory, 'cursor')
+
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._read_segment, self._read_offset = self._load_cursor()
+        self._pending = 0
+
+        if not self._segments:
+            self._new_segment(self._read_segment, 0)
+            return
+
+        # Recover the number of unread records and where the last write ended
+        for segment_id in self._segments:
+            start = self._read_offset if segment_id == self._read_segment else 0
+            count, end = self._scan(segment_id, start)
+            self._pending += count
+        self._write_segment = self._segments[-1]
+        self._write_offset = end
+        logger.info(f"Recovered spool in {directory} with {self._pending} unsent messages")
+
+    def __len__(self):
+        return self._pending
+
+    def is_empty(self):
+        return self._pending == 0
+
+    def append(self, value):
+        """ Appends one message to the end of the spool """
+        if not value:
+            raise ValueError("Cannot spool an empty message")
+
+        size = HEADER.size + len(value)
+        with self._lock:
+            if self._write_offset + size > len(self._maps[self._write_segment]):
+                self._flush()
+                self._new_segment(self._write_segment + 1, size)
+
+            data = self._maps[self._write_segment]
+            offset = self._write_offset
+            data[offset:offset + HEADER.size] = HEADER.pack(len(value), zlib.crc32(value))
+            data[offset + HEADER.size:offset + size] = value
+            self._write_offset += size
+            self._pending += 1
+            self._dirty = True
+
+            if self.fsync == 'always' or (
+                    self.fsync == 'interval' and time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._flush()
+
+    def read(self, max_records):
+        """
+        Returns up to max_records messages from the read cursor onwards and
+        the position after the last one, to be passed to commit() once the
+        messages have been handled.
+        """
+        with self._lock:
+            records = []
+            segment_id, offset = self._read_segment, self._read_offset
+            while len(records) < max_records:
+                value, next_offset = self._read_record(segment_id, offset)
+                if value is None:
+                    if segment_id == self._write_segment:
+                        break
+                    segment_id = self._segments[self._segments.index(segment_id) + 1]
+                    offset = 0
+                    continue
+                records.append(value)
+                offset = next_offset
+            return records, (segment_id, offset)
+
+    def commit(self, position, count):
+        """ Moves the read cursor past messages returned by read() """
+        with self._lock:
+            self._read_segment, self._read_offset = position
+            self._pending -= count
+
+            for segment_id in [s for s in self._segments if s < self._read_segment]:
+                self._maps.pop(segment_id).close()
+                os.remove(self._segment_path(segment_id))
+                self._segments.remove(segment_id)
+
+            tmp_file = self._cursor_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(f"{self._read_segment} {self._read_offset}")
+                if self.fsync != 'never':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_file, self._cursor_file)
+
+    def sync(self):
+        """ Flushes pending writes if the fsync interval has passed """
+        with self._lock:
+            if self._dirty and time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            for data in self._maps.values():
+                data.close()
+            self._maps.clear()
+
+    def _flush(self):
+        if self._dirty and self.fsync != 'never':
+            self._maps[self._write_segment].flush()
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:010d}{SEGMENT_SUFFIX}")
+
+    def _load_cursor(self):
+        first = self._segments[0] if self._segments else 1
+        try:
+            with open(self._cursor_file, 'r') as f:
+                segment_id, offset = (int(part) for part in f.read().split())
+        except (OSError, ValueError):
+            return first, 0
+        if segment_id not in self._segments:
+            return first, 0
+        return segment_id, offset
+
+    def _new_segment(self, segment_id, min_size):
+        path = self._segment_path(segment_id)
+        with open(path, 'wb') as f:
+            f.truncate(max(self.segment_size, min_size))
+        self._open_segment(segment_id)
+        if segment_id not in self._segments:
+            self._segments.append(segment_id)
+        self._write_segment = segment_id
+        self._write_offset = 0
+
+    def _open_segment(self, segment_id):
+        if segment_id not in self._maps:
+            with open(self._segment_path(segment_id), 'r+b') as f:
+                self._maps[segment_id] = mmap.mmap(f.fileno(), 0)
+        return self._maps[segment_id]
+
+    def _read_record(self, segment_id, offset):
+        data = self._open_segment(segment_id)
+        if offset + HEADER.size > len(data):
+            return None, offset
+
+        length, crc = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if length == 0 or end > len(data):
+            return None, offset
+
+        value = data[offset + HEADER.size:end]
+        if zlib.crc32(value) != crc:
+            # A torn write from a crash, nothing after it in this segment is valid
+            logger.warning(f"Corrupt record in spool segment {segment_id} at offset {offset}")
+            return None, offset
+        return value, end
+
+    def _scan(self, segment_id, offset):
+        count = 0
+        while True:
+            value, next_offset = self._read_record(segment_id, offset)
+            if value is None:
+                return count, offset
+            count += 1
+            offset = next_offset
@@ -0,0 +1,39 @@
+"""
+Runs the receiver on the dev config, with logs in a temporary directory
+and without the spool, so tests talk to the producer directly.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import yaml
+
+RECEIVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(os.path.dirname(RECEIVER_DIR), 'config', 'dev', 'receiver')
+
+TMP_DIR = tempfile.mkdtemp(prefix='receiver-tests-')
+TEST_CONFIG_DIR = os.path.join(TMP_DIR, 'config', 'dev', 'receiver')
+shutil.copytree(CONFIG_DIR, TEST_CONFIG_DIR)
+
+with open(os.path.join(TEST_CONFIG_DIR, 'receiver_app_conf.yml')) as f:
+    app_conf = yaml.safe_load(f)
+app_conf['spool']['enabled'] = False
+app_conf['rate_limit']['enabled'] = False
+with open(os.path.join(TEST_CONFIG_DIR, 'receiver_app_conf.yml'), 'w') as f:
+    yaml.safe_dump(app_conf, f)
+
+with open(os.path.join(TEST_CONFIG_DIR, 'receiver_log_conf.yml')) as f:
+    log_conf = yaml.safe_load(f)
+log_conf['handlers']['file']['filename'] = os.path.join(TMP_DIR, 'receiver.log')
+log_conf['queue']['enabled'] = False
+with open(os.path.join(TEST_CONFIG_DIR, 'receiver_log_conf.yml'), 'w') as f:
+    yaml.safe_dump(log_conf, f)
+
+os.environ['ENV'] = 'dev'
+os.environ['CONFIG_PATH'] = os.path.join(TMP_DIR, 'config')
+os.environ['RECEIVER_NODE_ID'] = '0'
+sys.path.insert(0, RECEIVER_DIR)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
@@ -0,0 +1,41 @@
+import os
+import app
+from producer import EventProducer
+from test_producer import FakeTopic
+from trace_ids import SnowflakeGenerator
+
+
+def test_batch_reports_non_object_items_one_by_one(monkeypatch):
+    producer = EventProducer(FakeTopic(), {'mode': 'async'})
+    monkeypatch.setattr(app, "producer", producer)
+    monkeypatch.setattr(app, "trace_ids", SnowflakeGenerator(0))
+    monkeypatch.setattr(app, "worker_pid", os.getpid())
+
+    response = app.app.test_client().post("/receiver/events/batch", json=[
+        {"type": "temperature", "device_id": "thermostat-1", "temperature": 21, "event_type": "temperature"},
+        "not an event",
+        42,
+        {"type": ["temperature"], "device_id": "thermostat-1"},
+        {"type": {}, "device_id": "thermostat-1"},
+    ])
+    producer.stop()
+
+    assert response.status_code == 207
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == [201, 400, 400, 400, 400]
+    assert results[1]["error"] == "Item is not a valid JSON object"
+    assert results[3]["error"] == results[4]["error"] == "Unknown event type"
+
+
+def test_batch_without_valid_items_is_rejected(monkeypatch):
+    producer = EventProducer(FakeTopic(), {'mode': 'async'})
+    monkeypatch.setattr(app, "producer", producer)
+    monkeypatch.setattr(app, "trace_ids", SnowflakeGenerator(0))
+    monkeypatch.setattr(app, "worker_pid", os.getpid())
+
+    response = app.app.test_client().post("/receiver/events/batch", json=["not an event", {"type": "x"}])
+    producer.stop()
+
+    assert response.status_code == 400
+    assert response.json()["rejected"] == 2
+    assert [result["status"] for result in response.json()["results"]] == [400, 400]
@@ -0,0 +1,37 @@
+import pytest
+import app
+
+
+def test_claim_slot_takes_the_lowest_free_slot(tmp_path):
+    first, first_lock = app.claim_slot(str(tmp_path), limit=3)
+    second, second_lock = app.claim_slot(str(tmp_path), limit=3)
+    assert (first, second) == (0, 1)
+
+    # A slot is free again once its process lets go of the lock
+    first_lock.close()
+    again, again_lock = app.claim_slot(str(tmp_path), limit=3)
+    assert again == 0
+
+    third, third_lock = app.claim_slot(str(tmp_path), limit=3)
+    assert third == 2
+    with pytest.raises(RuntimeError):
+        app.claim_slot(str(tmp_path), limit=3)
+
+
+def test_node_id_is_claimed_without_one_configured(tmp_path, monkeypatch):
+    monkeypatch.delenv("RECEIVER_NODE_ID")
+    monkeypatch.setitem(app.app_config['trace_ids'], 'node_lock_directory', str(tmp_path))
+    assert app.configured_node_id() is None
+    # Each lock file is held by its worker for as long as it runs
+    claims = [app.claim_node_id(), app.claim_node_id()]
+    assert [node_id for node_id, _ in claims] == [0, 1]
+
+    monkeypatch.setitem(app.app_config['trace_ids'], 'node_lock_directory', None)
+    with pytest.raises(ValueError):
+        app.configured_node_id()
+
+
+def test_configured_node_id_must_fit_beside_the_worker_bits(monkeypatch):
+    monkeypatch.setenv("RECEIVER_NODE_ID", str(app.max_node_id() + 1))
+    with pytest.raises(ValueError):
+        app.configured_node_id()
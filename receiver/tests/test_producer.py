@@ -0,0 +1,133 @@
+import os
+import time
+from queue import Queue
+from threading import Event
+import pytest
+import app
+from producer import EventProducer, ProducerQueueFull
+from trace_ids import SnowflakeGenerator
+
+
+class FakeMessage:
+    def __init__(self, value, partition_key):
+        self.value = value
+        self.partition_key = partition_key
+
+
+class FakeProducer:
+    """ Stands in for a pykafka producer, reporting each message as soon as it is produced """
+
+    def __init__(self, delivery_reports=False, **kwargs):
+        self.delivery_reports = delivery_reports
+        self.produced = []
+        # Exception to report per message value, and False to hold back every report
+        self.errors = {}
+        self.reporting = True
+        # Cleared, produce() blocks like a producer whose buffer is full
+        self.release = Event()
+        self.release.set()
+        self.reports = Queue()
+
+    def produce(self, value, partition_key=None):
+        self.release.wait()
+        msg = FakeMessage(value, partition_key)
+        self.produced.append(msg)
+        if self.delivery_reports and self.reporting:
+            self.reports.put((msg, self.errors.get(value)))
+        return msg
+
+    def get_delivery_report(self, block=True, timeout=None):
+        return self.reports.get(block, timeout)
+
+    def stop(self):
+        self.release.set()
+
+
+class FakeTopic:
+    def get_producer(self, **kwargs):
+        self.producer = FakeProducer(**kwargs)
+        return self.producer
+
+    def get_sync_producer(self, **kwargs):
+        self.producer = FakeProducer(**kwargs)
+        return self.producer
+
+
+@pytest.fixture
+def topic():
+    return FakeTopic()
+
+
+@pytest.fixture
+def producer(topic):
+    producer = EventProducer(topic, {'mode': 'async', 'max_queued_messages': 1, 'retry_after_s': 3})
+    yield producer
+    topic.producer.release.set()
+    producer.stop()
+
+
+def fill_queue(producer, topic):
+    """ Leaves one message stuck in produce() and another filling the queue """
+    topic.producer.release.clear()
+    producer.send(b"first")
+    while producer.queue_depth():
+        time.sleep(0.001)
+    producer.send(b"second")
+
+
+def test_async_send_raises_when_the_queue_is_full(producer, topic):
+    fill_queue(producer, topic)
+    with pytest.raises(ProducerQueueFull):
+        producer.send(b"third")
+
+
+def test_full_queue_answers_503_with_retry_after(producer, topic, monkeypatch):
+    fill_queue(producer, topic)
+    monkeypatch.setattr(app, "producer", producer)
+    monkeypatch.setattr(app, "trace_ids", SnowflakeGenerator(0))
+    monkeypatch.setattr(app, "worker_pid", os.getpid())
+
+    client = app.app.test_client()
+    response = client.post("/receiver/events/temperature",
+                           json={"device_id": "thermostat-1", "temperature": 21, "event_type": "temperature"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+    response = client.post("/receiver/events/batch",
+                           json=[{"type": "motion", "device_id": "sensor-1", "room": "hall", "motion_intensity": 4}])
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+
+def test_delivery_reports_reach_the_callbacks(topic):
+    reports = []
+    producer = EventProducer(topic, {'mode': 'async'}, on_delivery=lambda value, exc: reports.append((value, exc)))
+    error = Exception("broker down")
+    topic.producer.errors[b"lost"] = error
+    delivered = Event()
+    producer.send(b"kept", callback=lambda value, exc: delivered.set())
+    producer.send(b"lost")
+    producer.stop()
+
+    assert delivered.is_set()
+    assert reports == [(b"lost", error)]
+    assert (producer.delivered, producer.failed, producer.healthy) == (1, 1, False)
+
+
+def test_send_all_reports_each_message(topic):
+    producer = EventProducer(topic, {'mode': 'async'})
+    error = Exception("broker down")
+    topic.producer.errors[b"b"] = error
+    assert producer.send_all([(b"a", b"k"), (b"b", b"k")], timeout=5) == [None, error]
+    producer.stop()
+
+
+def test_send_all_times_out_without_reports(topic):
+    producer = EventProducer(topic, {'mode': 'async'})
+    topic.producer.reporting = False
+    started = time.monotonic()
+    results = producer.send_all([(b"a", b"k"), (b"b", b"k")], timeout=0.2)
+    producer.stop()
+
+    assert time.monotonic() - started < 2
+    assert all(isinstance(result, TimeoutError) for result in results)
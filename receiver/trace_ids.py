@@ -0,0 +1,38 @@
+import time
+from threading import Lock
+
+# Snowflake layout: 41 bits of milliseconds since EPOCH_MS, 10 bits of node
+# ID and a 12 bit per-millisecond sequence, which keeps IDs positive and
+# inside the BigInteger trace_id columns.
+EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    """
+    Generates 63-bit trace IDs that are unique across receiver replicas
+    (as long as each has its own node ID) and strictly increasing within a
+    process. If the clock goes backwards or more than 4096 IDs are needed
+    in one millisecond, the generator runs ahead of the clock instead of
+    waiting for it.
+    """
+
+    def __init__(self, node_id):
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"Node ID must be between 0 and {MAX_NODE_ID}, got {node_id}")
+        self.node_id = node_id
+        self._last = 0
+        self._lock = Lock()
+
+    def next_id(self):
+        now = (time.time_ns() // 1000000 - EPOCH_MS) << SEQUENCE_BITS
+        with self._lock:
+            # The low bits of _last hold the sequence, so one increment covers
+            # both the next sequence number and rolling over to the next ms
+            self._last = max(now, self._last + 1)
+            last = self._last
+        timestamp, sequence = last >> SEQUENCE_BITS, last & MAX_SEQUENCE
+        return (timestamp << (NODE_BITS + SEQUENCE_BITS)) | (self.node_id << SEQUENCE_BITS) | sequence
@@ -1,16 +1,40 @@
 import connexion
 import os
+import sys
+import time
+import atexit
+import signal
+import multiprocessing
+import heapq
+from functools import partial
+from itertools import chain, islice, takewhile
+from operator import itemgetter
 import json
 import yaml
 import logging
 import logging.config
+import log_setup
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from threading import Thread
-from db_setup import DB_SESSION
+from threading import Thread, Event
+from db_setup import DB_SESSION, engine
+from ingest import BatchConsumer
+from dedup import TraceIdCache, DedupStats
+from health import ConsumerHealth
+from dead_letter import DeadLetterFile
+from rollups import BUCKETS as ROLLUP_BUCKETS, VALUE_FIELDS
+import counters
+import archive
+import id_codec
+from response_cache import ResponseCache, etag, etag_matches
 from models import temperatureEvent, motionEvent
-from datetime import datetime
+import wire
+from datetime import datetime, timedelta
 from connexion import NoContent
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import JSONResponseBodyValidator, VALIDATOR_MAP
+from flask import Response, request
+from sqlalchemy import select, func
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -24,129 +48,380 @@ APP_CONF_FILE = os.path.join(FULL_CONFIG_PATH, 'storage_app_conf.yaml')
 
 with open(LOG_CONF_FILE, 'r') as f:
     log_conf = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_conf)
+    log_setup.setup_logging(log_conf)
 
 with open(APP_CONF_FILE, 'r') as f:
     app_conf = yaml.safe_load(f.read())
 
 logger = logging.getLogger('basicLogger')
-
-def process_messages():
-    """ Process event messages """
-    logger.info("Starting Kafka consumer...")
-
+# Per-event lines, sampled and formatted lazily (see storage_log_conf.yml)
+event_logger = logging.getLogger('basicLogger.events')
+
+# /counts reads the counters table instead of counting rows
+COUNTERS_ENABLED = app_conf.get('counters', {}).get('enabled', False)
+
+# Consumer threads share one cache, forked consumer processes each get a copy
+# of it, which suits them since each owns its own partitions
+dedup_cache = TraceIdCache(app_conf.get('dedup', {}).get('cache_size', 100000))
+dedup_stats = DedupStats()
+
+# Messages the consumers can't store end up here instead of stopping them
+dead_letter = DeadLetterFile(app_conf.get('dead_letter', {}).get('path', '/app/logs/storage_dead_letter.ndjson'))
+
+# Set by serve.py, whose ingestion process runs the consumers and reports
+# their stats to this file for the processes serving requests
+INGESTION_STATUS_FILE = os.environ.get('INGESTION_STATUS_FILE')
+
+# Events moved out of the tables by the retention policy are read back from here
+retention_conf = app_conf.get('retention', {})
+ARCHIVE_DIRECTORY = retention_conf.get('directory')
+
+# Event query responses for ranges that can't change anymore
+cache_conf = app_conf.get('response_cache', {})
+response_cache = ResponseCache(cache_conf.get('max_bytes', 64 * 1024 * 1024)) if cache_conf.get('enabled', False) else None
+
+def consumer_settings():
+    """ Batch limits and consumer group settings from the storage config """
+    batch_conf = app_conf.get('batch', {})
+    if batch_conf.get('enabled', False):
+        max_size = batch_conf.get('max_size', 500)
+        max_wait_ms = batch_conf.get('max_wait_ms', 200)
+    else:
+        # One transaction and offset commit per message
+        max_size, max_wait_ms = 1, 0
+    return max_size, max_wait_ms, app_conf.get('consumers', {})
+
+def log_rebalance(name, consumer, old_partition_offsets, new_partition_offsets):
+    """ Logs the partitions a balanced consumer owns after a rebalance, the offsets are keyed by partition id """
+    partitions = sorted(new_partition_offsets)
+    logger.info(f"{name} now owns partitions {partitions}")
+
+def create_consumer(name, max_wait_ms, consumers_conf):
+    """ Connects to Kafka and creates the consumer of one worker """
     kafka_host = os.environ.get('KAFKA_HOST', app_conf['events']['hostname'])
     kafka_port = os.environ.get('KAFKA_PORT', app_conf['events']['port'])
     kafka_topic = os.environ.get('KAFKA_TOPIC', app_conf['events']['topic'])
 
+    #sets up a connection to the kafka broker using hostname and port
     hostname = f"{kafka_host}:{kafka_port}"
     client = KafkaClient(hosts=hostname)
     logger.info(f"Connected to Kafka at {hostname}")
-
+    #sets a topic location, where events will be sent and stored
     topic = client.topics[str.encode(kafka_topic)]
+    logger.info(f"Found topic: {kafka_topic}")
+
+    options = {
+        "consumer_group": b'event_group',
+        "reset_offset_on_start": False,
+        "auto_offset_reset": OffsetType.LATEST,
+        # Wakes the consumer up to flush a partial batch on an idle topic
+        "consumer_timeout_ms": max(max_wait_ms, 100)
+    }
+
+    if consumers_conf.get('mode', 'simple') == 'balanced':
+        # Members of the group split the topic's partitions between them
+        # and rebalance whenever one joins or leaves
+        return topic.get_balanced_consumer(
+            managed=True,
+            auto_commit_enable=False,
+            post_rebalance_callback=partial(log_rebalance, name),
+            **options
+        )
+    return topic.get_simple_consumer(**options)
 
+def process_messages(stopping=None, name="consumer", health=None):
+    """
+    Process event messages. Whatever stops the consumer, Kafka or the
+    database going away or an unexpected error, is logged and the consumer
+    is created again after a backoff, so ingestion recovers on its own.
+    """
+    logger.info(f"Starting Kafka {name}...")
+    stopping = stopping or Event()
+    health = health or ConsumerHealth(name)
+    max_size, max_wait_ms, consumers_conf = consumer_settings()
+    restart_delay = consumers_conf.get('restart_delay_s', 1)
+    max_restart_delay = consumers_conf.get('max_restart_delay_s', 60)
+
+    delay = restart_delay
+    while not stopping.is_set():
+        started = time.monotonic()
+        try:
+            consumer = create_consumer(name, max_wait_ms, consumers_conf)
+            logger.info(f"{name} created and ready to receive messages, batches of up to {max_size} "
+                        f"messages or {max_wait_ms}ms")
+
+            BatchConsumer(consumer, engine, wire.decode, max_size, max_wait_ms, stopping, name,
+                          dedup_cache, dedup_stats, app_conf.get('rollups', {}).get('enabled', False),
+                          COUNTERS_ENABLED, dead_letter, health,
+                          consumers_conf.get('max_retries', 5),
+                          consumers_conf.get('retry_backoff_s', 0.5),
+                          consumers_conf.get('max_retry_backoff_s', 30),
+                          consumers_conf.get('lag_interval_s', 10)).run()
+
+        except Exception as e:
+            logger.error(f"Error processing message: {str(e)}")
+
+        if stopping.is_set():
+            break
+        # A consumer that ran for a while before failing starts over quickly
+        if time.monotonic() - started > max_restart_delay:
+            delay = restart_delay
+        health.set_state("restarting")
+        health.add_restarts(1)
+        logger.warning(f"Restarting {name} in {delay}s")
+        if stopping.wait(delay):
+            break
+        delay = min(delay * 2, max_restart_delay)
+
+    health.set_state("stopped")
+
+def run_consumer_process(stopping, name, health):
+    """ Entry point of a consumer worker process """
+    # Forked processes don't inherit the log listener threads or the parent's
+    # database connections
+    listeners = log_setup.setup_logging(log_conf)
+    engine.dispose(close=False)
     try:
-        #sets up a connection to the kafka broker using hostname and port
-        hostname = f"{app_conf['events']['hostname']}:{app_conf['events']['port']}"
-        client = KafkaClient(hosts=hostname)
-        logger.info(f"Connected to Kafka at {hostname}")
-        #sets a topic location, where events will be sent and stored
-        topic = client.topics[str.encode(app_conf['events']['topic'])]
-        logger.info(f"Found topic: {app_conf['events']['topic']}")
-
-        consumer = topic.get_simple_consumer(
-            consumer_group=b'event_group',
-            reset_offset_on_start=False,
-            auto_offset_reset=OffsetType.LATEST
-        )
-        logger.info("Consumer created and ready to receive messages")
+        process_messages(stopping, name, health)
+    finally:
+        # Processes exit without running atexit handlers
+        for listener in listeners:
+            listener.stop()
 
-        for msg in consumer:
-            logger.info("Received message - processing...")
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            logger.info(f"Message: {msg}")
+try:
+    import orjson
 
-            payload = msg["payload"]
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, default=datetime.isoformat).encode('utf-8')
 
-            session = DB_SESSION()
+def parse_range(start_timestamp, end_timestamp):
+    """ Parses the start and end of a time range query """
+    if start_timestamp.endswith('Z'):
+        start_timestamp = start_timestamp[:-1]
+    if end_timestamp.endswith('Z'):
+        end_timestamp = end_timestamp[:-1]
 
-            if msg["type"] == "temperature":
-                temperature = temperatureEvent(
-                    device_id=payload['device_id'],
-                    temperature=payload['temperature'],
-                    timestamp=datetime.strptime(msg['datetime'], "%Y-%m-%dT%H:%M:%S"),
-                    event_type=payload['event_type'],
-                    trace_id=payload['trace_id']
-                )
-                session.add(temperature)
-                logger.info(f"Stored temperature event with trace id: {payload['trace_id']}")
-
-            elif msg["type"] == "motion":
-                motion = motionEvent(
-                    device_id=payload['device_id'],
-                    room=payload['room'],
-                    motion_intensity=payload['motion_intensity'],
-                    timestamp=datetime.strptime(msg['datetime'], "%Y-%m-%dT%H:%M:%S"),
-                    trace_id=payload['trace_id']
-                )
-                session.add(motion)
-                logger.info(f"Stored motion event with trace id: {payload['trace_id']}")
+    return datetime.fromisoformat(start_timestamp), datetime.fromisoformat(end_timestamp)
 
-            session.commit()
-            session.close()
-            consumer.commit_offsets()
-            logger.info("Message processing completed")
+def event_query(model, fields, start, end, limit=None, after_id=None):
+    """
+    Selects the given columns of the events of a time range, plus the id as
+    the last column for paging. With limit or after_id the events come in
+    id order, starting after after_id, so a client can page through the
+    range by passing the last id it got as the next after_id.
+    """
+    table = model.__table__
+    query = select(*(table.c[name] for name in fields), table.c.id).where(
+        table.c.timestamp >= start,
+        table.c.timestamp < end
+    )
 
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}")
+    if limit is not None or after_id is not None:
+        query = query.order_by(table.c.id)
+    if after_id is not None:
+        query = query.where(table.c.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
 
-def get_temperature_events(start_timestamp, end_timestamp):
-    """Gets temperature events between the given start and end timestamps."""
-    session = DB_SESSION()
+def merge_archived(rows, archived, limit=None, after_id=None):
+    """
+    Combines events read from an event table with archived ones. Pages come
+    in id order, so for those both are merged by id and cut to the limit.
+    """
+    if limit is None and after_id is None:
+        return chain(archived, rows)
+    merged = heapq.merge(archived, rows, key=itemgetter(-1))
+    return islice(merged, limit) if limit is not None else merged
 
-    if start_timestamp.endswith('Z'):
-        start_timestamp = start_timestamp[:-1]
-    if end_timestamp.endswith('Z'):
-        end_timestamp = end_timestamp[:-1]
+def stream_events(query, fields, event_type, archived=None, limit=None, after_id=None):
+    """
+    Streams query results as NDJSON. Rows are fetched through a server-side
+    cursor in chunks, so memory use doesn't grow with the size of the range.
+    """
+    chunk_size = app_conf.get('queries', {}).get('stream_chunk_size', 1000)
+
+    def chunks(result):
+        if archived is None:
+            return result.partitions()
+        rows = merge_archived(result, archived, limit, after_id)
+        return iter(lambda: list(islice(rows, chunk_size)), [])
+
+    def body():
+        count = 0
+        try:
+            with engine.connect() as connection:
+                result = connection.execute(query.execution_options(yield_per=chunk_size))
+                for rows in chunks(result):
+                    count += len(rows)
+                    yield b"".join(dumps(dict(zip(fields, row))) + b"\n" for row in rows)
+        finally:
+            logger.info(f"Streamed {count} {event_type} events")
+
+    return Response(body(), status=200, mimetype="application/x-ndjson")
+
+def archived_events(event_type, fields, start, end, after_id=None):
+    """ Archived events of a range in id order, or None if no archive segment can hold any """
+    if not ARCHIVE_DIRECTORY:
+        return None
+    with engine.connect() as connection:
+        segments = archive.find_segments(connection, event_type, start, end, after_id)
+    if not segments:
+        return None
+    return archive.read_segments(ARCHIVE_DIRECTORY, segments, fields, start, end, after_id)
+
+def read_events(model, event_type, fields, start, end, limit=None, after_id=None):
+    """
+    Reads the events of a range as plain tuples, including archived ones,
+    and encodes them straight to JSON without building ORM objects. Returns
+    the body and headers of the response.
+    """
+    query = event_query(model, fields, start, end, limit, after_id)
+    archived = archived_events(event_type, fields, start, end, after_id)
 
-    start = datetime.fromisoformat(start_timestamp)
-    end = datetime.fromisoformat(end_timestamp)
+    with engine.connect() as connection:
+        rows = connection.execute(query).all()
+    if archived is not None:
+        rows = list(merge_archived(rows, archived, limit, after_id))
 
-    temperature_events = session.query(temperatureEvent).filter(
-        temperatureEvent.timestamp >= start,
-        temperatureEvent.timestamp < end
-    ).all()
+    logger.info(f"Found {len(rows)} {event_type} events")
 
-    results = [event.to_dict() for event in temperature_events]
-    session.close()
+    # A full page means there may be more, the client continues after the last id
+    headers = {"Content-Type": "application/json"}
+    if limit is not None and len(rows) == limit:
+        headers["X-Next-After-Id"] = str(rows[-1][-1])
+    return dumps([dict(zip(fields, row)) for row in rows]), headers
 
-    logger.info(f"Found {len(results)} temperature events")
-    return results, 200
+def cache_ttl(end):
+    """
+    Seconds the response for a range ending at end may be cached: None
+    while it stays in the cache, 0 for not at all. Ranges that ended more
+    than closed_after_s ago rarely get new events, but a replayed spool or
+    a consumer catching up can still add some, so they are kept for
+    closed_ttl_s. The others only get open_ttl_s.
+    """
+    if end <= datetime.now() - timedelta(seconds=cache_conf.get('closed_after_s', 300)):
+        return cache_conf.get('closed_ttl_s', 600)
+    return cache_conf.get('open_ttl_s', 0)
 
-def get_motion_events(start_timestamp, end_timestamp):
-    """Gets motion events between the given start and end timestamps."""
-    session = DB_SESSION()
+def get_events(model, event_type, start_timestamp, end_timestamp, limit=None, after_id=None, stream=False,
+               fields=None):
+    """
+    Gets the events of one type between the given start and end timestamps.
+    Responses carry an ETag, a request whose If-None-Match matches it gets
+    a 304 without a body.
+    """
+    fields = fields or [column.name for column in model.__table__.columns]
+    start, end = parse_range(start_timestamp, end_timestamp)
+    if stream:
+        query = event_query(model, fields, start, end, limit, after_id)
+        return stream_events(query, fields, event_type, archived_events(event_type, fields, start, end, after_id),
+                             limit, after_id)
+
+    cached = None
+    if response_cache is not None:
+        key = (event_type, start, end, limit, after_id, tuple(fields))
+        cached = response_cache.get(key)
+
+    if cached is None:
+        body, headers = read_events(model, event_type, fields, start, end, limit, after_id)
+        tag = etag(body)
+        ttl = cache_ttl(end) if response_cache is not None else 0
+        if ttl != 0:
+            response_cache.put(key, body, headers, tag, ttl)
+    else:
+        body, headers, tag = cached
+
+    if etag_matches(request.headers.get("If-None-Match"), tag):
+        return Response(status=304, headers={"ETag": tag})
+    return Response(body, status=200, headers={**headers, "ETag": tag})
+
+def get_temperature_events(start_timestamp, end_timestamp, limit=None, after_id=None, stream=False, fields=None):
+    """Gets temperature events between the given start and end timestamps."""
+    return get_events(temperatureEvent, "temperature", start_timestamp, end_timestamp, limit, after_id, stream,
+                      fields)
 
-    if start_timestamp.endswith('Z'):
-        start_timestamp = start_timestamp[:-1]
-    if end_timestamp.endswith('Z'):
-        end_timestamp = end_timestamp[:-1]
+def get_motion_events(start_timestamp, end_timestamp, limit=None, after_id=None, stream=False, fields=None):
+    """Gets motion events between the given start and end timestamps."""
+    return get_events(motionEvent, "motion", start_timestamp, end_timestamp, limit, after_id, stream, fields)
 
-    start = datetime.fromisoformat(start_timestamp)
-    end = datetime.fromisoformat(end_timestamp)
+def add_values(aggregate, values):
+    """ Folds readings into a count/sum/min/max aggregate """
+    for value in values:
+        aggregate["count"] += 1
+        aggregate["sum"] = value if aggregate["sum"] is None else aggregate["sum"] + value
+        aggregate["min"] = value if aggregate["min"] is None else min(aggregate["min"], value)
+        aggregate["max"] = value if aggregate["max"] is None else max(aggregate["max"], value)
 
-    motion_events = session.query(motionEvent).filter(
-        motionEvent.timestamp >= start,
-        motionEvent.timestamp < end
-    ).all()
+def get_event_stats(start_timestamp, end_timestamp):
+    """
+    Gets the count, sum, min and max of the readings of each event type
+    between the given start and end timestamps. The database computes them,
+    so only these numbers are sent instead of every event.
+    """
+    start, end = parse_range(start_timestamp, end_timestamp)
+    results = {}
+    segments = {}
+    with engine.connect() as connection:
+        for event_type, model in (("temperature", temperatureEvent), ("motion", motionEvent)):
+            table = model.__table__
+            value = table.c[VALUE_FIELDS[event_type]]
+            count, total, low, high = connection.execute(
+                select(func.count(), func.sum(value), func.min(value), func.max(value)).where(
+                    table.c.timestamp >= start,
+                    table.c.timestamp < end
+                )
+            ).one()
+            # MySQL sums integer columns as DECIMAL
+            results[event_type] = {
+                "count": count,
+                "sum": float(total) if total is not None else None,
+                "min": low,
+                "max": high
+            }
+            if ARCHIVE_DIRECTORY:
+                segments[event_type] = archive.find_segments(connection, event_type, start, end)
 
-    results = [event.to_dict() for event in motion_events]
-    session.close()
+    for event_type, paths in segments.items():
+        if paths:
+            rows = archive.read_segments(ARCHIVE_DIRECTORY, paths, [VALUE_FIELDS[event_type]], start, end)
+            add_values(results[event_type], (row[0] for row in rows))
 
-    logger.info(f"Found {len(results)} motion events")
+    logger.info(f"Aggregated {results['temperature']['count']} temperature and "
+                f"{results['motion']['count']} motion events")
     return results, 200
 
+def get_rollups(type, bucket, start, end, device_id=None):
+    """
+    Gets the per-device count, sum, min, max and average of one event
+    type's readings, in minute or hour buckets between start and end.
+    """
+    table = ROLLUP_BUCKETS[bucket]
+    start, end = parse_range(start, end)
+    query = select(
+        table.c.device_id, table.c.bucket_start, table.c["count"], table.c["sum"], table.c["min"], table.c["max"]
+    ).where(
+        table.c.event_type == type,
+        table.c.bucket_start >= start,
+        table.c.bucket_start < end
+    ).order_by(table.c.device_id, table.c.bucket_start)
+    if device_id is not None:
+        query = query.where(table.c.device_id == device_id)
+
+    with engine.connect() as connection:
+        rows = connection.execute(query).all()
+
+    results = [
+        {"device_id": device, "bucket_start": bucket_start, "count": count,
+         "sum": total, "min": low, "max": high, "avg": total / count}
+        for device, bucket_start, count, total, low, high in rows
+    ]
+    logger.info(f"Found {len(results)} {bucket} rollups of {type} events")
+    return Response(dumps(results), status=200, mimetype="application/json")
+
 # Add these functions to your storage app.py file
 
 def get_event_counts():
@@ -160,13 +435,19 @@ def get_event_counts():
     session = DB_SESSION()
     
     try:
-        temperature_count = session.query(temperatureEvent).count()
-        motion_count = session.query(motionEvent).count()
-        
-        result = {
-            "temperature": temperature_count,
-            "motion": motion_count
-        }
+        if COUNTERS_ENABLED:
+            # Kept up to date by the consumers, so no table scans
+            result = counters.read_totals(session.connection())
+        else:
+            temperature_count = session.query(temperatureEvent).count()
+            motion_count = session.query(motionEvent).count()
+
+            result = {
+                "temperature": temperature_count,
+                "motion": motion_count
+            }
+            for event_type, total in archive.archived_totals(session.connection()).items():
+                result[event_type] += total
         
         logger.info(f"Retrieved event counts: {result}")
         return result, 200
@@ -178,7 +459,146 @@ def get_event_counts():
     finally:
         session.close()
 
-def get_temperature_ids():
+def get_device_counts(type=None):
+    """ Gets the number of stored events of each device """
+    if not COUNTERS_ENABLED:
+        return {"message": "Event counters are not enabled"}, 400
+
+    with engine.connect() as connection:
+        rows = counters.read_devices(connection, type)
+    logger.info(f"Retrieved event counts of {len(rows)} devices")
+    return [dict(row) for row in rows], 200
+
+def reconcile_event_counts():
+    """ Recounts the event tables and replaces the counters with the real counts """
+    if not COUNTERS_ENABLED:
+        return {"message": "Event counters are not enabled"}, 400
+
+    with engine.begin() as connection:
+        result = counters.reconcile(connection)
+    for event_type, counts in result.items():
+        if counts["stored"] != counts["actual"]:
+            logger.warning(f"{event_type} counter was {counts['stored']}, corrected to {counts['actual']}")
+    logger.info(f"Reconciled event counts: {result}")
+    return result, 200
+
+def consumer_dedup_stats():
+    result = dedup_stats.to_dict()
+    result["cache_size"] = len(dedup_cache)
+    return result
+
+def read_ingestion_status():
+    """ The latest status written by serve.py's ingestion process, or None if there is none yet """
+    try:
+        with open(INGESTION_STATUS_FILE, 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def consumer_status():
+    """ Health of every consumer worker, alive only if all of them are """
+    stall_s = consumer_settings()[2].get('stall_s', 30)
+    results = [health.to_dict(stall_s) for health in consumer_health]
+    lags = [result["lag"] for result in results if result["lag"] is not None]
+    return {
+        "alive": bool(results) and all(result["alive"] for result in results),
+        "lag": sum(lags) if lags else None,
+        "workers": results
+    }
+
+def get_consumer_status():
+    """ Gets whether the Kafka consumers are alive and how far behind they are, 503 if any isn't alive """
+    if INGESTION_STATUS_FILE:
+        status = read_ingestion_status()
+        if status is None:
+            return {"message": "The ingestion process has not reported yet"}, 503
+        result = status["consumers"]
+        # The ingestion process stopped reporting, so it is stuck or gone
+        age = (datetime.now() - datetime.fromisoformat(status["updated"])).total_seconds()
+        if age > consumer_settings()[2].get('stall_s', 30):
+            result = {**result, "alive": False}
+    else:
+        result = consumer_status()
+    return result, 200 if result["alive"] else 503
+
+def get_dedup_stats():
+    """ Gets how many consumed messages were replays, caught by the trace ID cache or by the database """
+    if INGESTION_STATUS_FILE:
+        status = read_ingestion_status()
+        if status is None:
+            return {"message": "The ingestion process has not reported yet"}, 503
+        return status["dedup"], 200
+    return consumer_dedup_stats(), 200
+
+def get_cache_stats():
+    """ Gets the size and hit, miss and eviction counts of the event query response cache """
+    if response_cache is None:
+        return {"message": "The response cache is not enabled"}, 400
+    return response_cache.to_dict(), 200
+
+def get_ids(model, event_type, since_id=None, since_timestamp=None, format="json"):
+    """
+    Gets the event IDs and trace IDs of one event type, only those stored
+    after the since_id watermark and at or after since_timestamp if given.
+    The next watermark, the highest id returned, is sent in the
+    X-Next-Since-Id header. The compact format sends just the trace IDs,
+    encoded by id_codec.encode_ids. Archived events are included.
+
+    The export stops before the first event with a timestamp in the last
+    id_export_lag_s seconds, and the next one starts there, so rows that
+    concurrent consumers commit out of id order are in before the
+    watermark passes them. That only holds for events stored within the
+    lag, since_id is exact with a single writer.
+    """
+    table = model.__table__
+    # Compared with the event timestamps, which are local times like now()
+    end = datetime.now() - timedelta(seconds=app_conf.get('queries', {}).get('id_export_lag_s', 10))
+    query = select(table.c.device_id, table.c.trace_id, table.c.timestamp, table.c.id).order_by(table.c.id)
+    start = None
+    if since_id is not None:
+        query = query.where(table.c.id > since_id)
+    if since_timestamp is not None:
+        start = parse_range(since_timestamp, since_timestamp)[0]
+        query = query.where(table.c.timestamp >= start)
+
+    with engine.connect() as connection:
+        segments = archive.find_segments(connection, event_type, start, None, since_id) if ARCHIVE_DIRECTORY else []
+        rows = connection.execute(query).all()
+
+    # Cut rather than filtered, a recent event left out must not end up
+    # below the watermark of the rows after it
+    recent = next((index for index, row in enumerate(rows) if row.timestamp >= end), None)
+    cut_id = rows[recent].id if recent is not None else None
+    rows = [(device_id, trace_id, row_id) for device_id, trace_id, _, row_id in rows[:recent]]
+    if segments:
+        archived = archive.read_segments(ARCHIVE_DIRECTORY, segments, ["device_id", "trace_id"], start, None, since_id)
+        if cut_id is not None:
+            archived = takewhile(lambda row: row[-1] < cut_id, archived)
+        rows = list(heapq.merge(archived, rows, key=itemgetter(-1)))
+
+    next_since_id = rows[-1][-1] if rows else (since_id or 0)
+    headers = {"X-Next-Since-Id": str(next_since_id)}
+    logger.info(f"Retrieved {len(rows)} {event_type} event IDs, next since_id is {next_since_id}")
+
+    if format == "compact":
+        result = {
+            "count": len(rows),
+            "next_since_id": next_since_id,
+            "encoding": id_codec.ENCODING,
+            "trace_ids": id_codec.encode_ids(trace_id for _, trace_id, _ in rows)
+        }
+        return result, 200, headers
+
+    result = [
+        {
+            "event_id": device_id,
+            "trace_id": trace_id
+        }
+        for device_id, trace_id, _ in rows
+    ]
+    return Response(dumps(result), status=200, headers=headers, mimetype="application/json")
+
+def get_temperature_ids(since_id=None, since_timestamp=None, format="json"):
     """
     Gets a list of event IDs and trace IDs for temperature events.
     
@@ -186,35 +606,13 @@ def get_temperature_ids():
         A list of dictionaries containing event_id and trace_id, and a 200 status code,
         or an error message and a 400 status code.
     """
-    session = DB_SESSION()
-    
     try:
-        # Select only the fields we need
-        events = session.query(
-            temperatureEvent.device_id,
-            temperatureEvent.trace_id
-        ).all()
-        
-        # Convert to list of dictionaries
-        result = [
-            {
-                "event_id": event.device_id,
-                "trace_id": event.trace_id
-            }
-            for event in events
-        ]
-        
-        logger.info(f"Retrieved {len(result)} temperature event IDs")
-        return result, 200
-    
+        return get_ids(temperatureEvent, "temperature", since_id, since_timestamp, format)
     except Exception as e:
         logger.error(f"Error retrieving temperature event IDs: {str(e)}")
         return {"message": f"Error retrieving temperature event IDs: {str(e)}"}, 400
-    
-    finally:
-        session.close()
 
-def get_motion_ids():
+def get_motion_ids(since_id=None, since_timestamp=None, format="json"):
     """
     Gets a list of event IDs and trace IDs for motion events.
     
@@ -222,41 +620,126 @@ def get_motion_ids():
         A list of dictionaries containing event_id and trace_id, and a 200 status code,
         or an error message and a 400 status code.
     """
-    session = DB_SESSION()
-    
     try:
-        # Select only the fields we need
-        events = session.query(
-            motionEvent.device_id,
-            motionEvent.trace_id
-        ).all()
-        
-        # Convert to list of dictionaries
-        result = [
-            {
-                "event_id": event.device_id,
-                "trace_id": event.trace_id
-            }
-            for event in events
-        ]
-        
-        logger.info(f"Retrieved {len(result)} motion event IDs")
-        return result, 200
-    
+        return get_ids(motionEvent, "motion", since_id, since_timestamp, format)
     except Exception as e:
         logger.error(f"Error retrieving motion event IDs: {str(e)}")
         return {"message": f"Error retrieving motion event IDs: {str(e)}"}, 400
-    
-    finally:
-        session.close()
+
+workers = []
+consumer_health = []
+stopping = None
 
 #This will listen for messages constantly in the background
 def setup_kafka_thread():
-    logger.info("Creating Kafka consumer thread")
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
-    logger.info("Kafka consumer thread started")
+    global stopping
+    _, _, consumers_conf = consumer_settings()
+    count = consumers_conf.get('workers', 1) if consumers_conf.get('mode', 'simple') == 'balanced' else 1
+    worker_type = consumers_conf.get('worker_type', 'thread')
+
+    logger.info(f"Creating {count} Kafka consumer {worker_type}(s)")
+    consumer_health.extend(ConsumerHealth(f"consumer-{i}") for i in range(count))
+    if worker_type == 'process':
+        stopping = multiprocessing.Event()
+        for i, health in enumerate(consumer_health):
+            workers.append(multiprocessing.Process(target=run_consumer_process,
+                                                   args=(stopping, f"consumer-{i}", health),
+                                                   name=f"consumer-{i}", daemon=True))
+    else:
+        stopping = Event()
+        for i, health in enumerate(consumer_health):
+            workers.append(Thread(target=process_messages, args=(stopping, f"consumer-{i}", health),
+                                  name=f"consumer-{i}", daemon=True))
+
+    for worker in workers:
+        worker.start()
+    atexit.register(stop_kafka_workers)
+    logger.info("Kafka consumer workers started")
+
+def stop_kafka_workers():
+    """ Lets every consumer flush the batch it is working on and leave the group """
+    if stopping is None or stopping.is_set():
+        return
+    logger.info("Stopping Kafka consumer workers")
+    stopping.set()
+    timeout = consumer_settings()[2].get('shutdown_timeout_s', 10)
+    for worker in workers:
+        worker.join(timeout)
+        if worker.is_alive():
+            logger.warning(f"{worker.name} did not stop within {timeout}s")
+
+def run_retention(stopping):
+    """ Moves events past their table's retention period to the archive, every interval_s """
+    interval = retention_conf.get('interval_s', 3600)
+    logger.info(f"Archiving events older than {retention_conf['max_age_days']} days every {interval}s")
+    while True:
+        try:
+            archive.enforce(engine, ARCHIVE_DIRECTORY, retention_conf['max_age_days'],
+                            retention_conf.get('batch_size', 10000), stopping)
+        except Exception as e:
+            logger.error(f"Error archiving events: {str(e)}")
+        if stopping.wait(interval):
+            break
+
+retention_stopping = Event()
+
+def setup_retention_thread():
+    if not retention_conf.get('enabled', False):
+        return
+    Thread(target=run_retention, args=(retention_stopping,), name="retention", daemon=True).start()
+    atexit.register(retention_stopping.set)
+
+def write_ingestion_status():
+    """ Replaces the status file read by the processes serving requests """
+    status = {
+        "updated": datetime.now().isoformat(),
+        "pid": os.getpid(),
+        "consumers": consumer_status(),
+        "dedup": consumer_dedup_stats()
+    }
+    partial_file = INGESTION_STATUS_FILE + ".tmp"
+    with open(partial_file, 'wb') as f:
+        f.write(dumps(status))
+    os.replace(partial_file, INGESTION_STATUS_FILE)
+
+def run_ingestion(stopping):
+    """
+    Runs the Kafka consumers and archiving until stopping is set, as
+    serve.py's ingestion process. Returns an error exit code once every
+    consumer has died, so the supervisor starts a new process.
+    """
+    logger.info(f"Ingestion process {os.getpid()} starting...")
+    interval = app_conf.get('serving', {}).get('status_interval_s', 2)
+    setup_kafka_thread()
+    setup_retention_thread()
+    try:
+        while not stopping.wait(interval):
+            write_ingestion_status()
+            if not any(worker.is_alive() for worker in workers):
+                logger.error("Every Kafka consumer worker has stopped")
+                return 1
+        return 0
+    finally:
+        stop_kafka_workers()
+        retention_stopping.set()
+
+class PassThroughResponseValidator(JSONResponseBodyValidator):
+    """ JSON response validator that operations can opt out of with x-skip-response-validation """
+
+    def wrap_send(self, send):
+        # Validation would buffer the whole body, which defeats streaming
+        if self._schema.get('x-skip-response-validation'):
+            return send
+        return super().wrap_send(send)
+
+# Connexion's "*/*json" response validator also matches application/x-ndjson
+validator_map = {
+    **VALIDATOR_MAP,
+    "response": MediaTypeDict({
+        **VALIDATOR_MAP["response"],
+        "*/*json": PassThroughResponseValidator,
+    }),
+}
 
 app = connexion.FlaskApp(__name__, specification_dir='.')
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
@@ -268,9 +751,12 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_methods=["*"],
         allow_headers=["*"],
     )
-app.add_api("receiver.yml", base_path="/storage", strict_validation=True, validate_responses=True)
+app.add_api("receiver.yml", base_path="/storage", strict_validation=True, validate_responses=True, validator_map=validator_map)
 
 if __name__ == "__main__":
     logger.info("Storage Service starting...")
+    # Exit normally on SIGTERM so the consumers get to flush
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     setup_kafka_thread()
+    setup_retention_thread()
     app.run(port=8090, host="0.0.0.0")
\ No newline at end of file
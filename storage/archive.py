@@ -0,0 +1,186 @@
+import os
+import gzip
+import heapq
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from operator import itemgetter
+from sqlalchemy import select, delete, func
+from models import temperatureEvent, motionEvent, archiveSegment
+
+# Archive of events past their table's retention period.
+#
+# Old events are moved out of the event tables into gzipped NDJSON segment
+# files, one per event type and day, under <directory>/<type>/<day>/. Each
+# segment has a row in archive_segments with the time range and ids it
+# holds, inserted in the same transaction that deletes its events from the
+# table. Queries only see segments through that catalog, so an event is
+# either in its table or in a listed segment, never both. A segment file
+# left behind by a failed transaction is never read.
+
+logger = logging.getLogger('basicLogger')
+
+SEGMENTS = archiveSegment.__table__
+
+TABLES = {
+    "temperature": temperatureEvent.__table__,
+    "motion": motionEvent.__table__,
+}
+
+try:
+    import orjson
+
+    dumps, loads = orjson.dumps, orjson.loads
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, default=datetime.isoformat).encode('utf-8')
+
+    loads = json.loads
+
+
+def segment_path(event_type, day, first_id, last_id):
+    """ Path of a segment relative to the archive directory """
+    return os.path.join(event_type, day.isoformat(), f"{first_id}-{last_id}.ndjson.gz")
+
+
+def write_segment(path, rows):
+    """ Writes rows to a gzipped NDJSON file, which only appears under its name once it is on disk """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + ".tmp"
+    with open(partial, "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as segment:
+            segment.write(b"".join(dumps(row) + b"\n" for row in rows))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+def archive_batch(connection, directory, event_type, cutoff, batch_size, written):
+    """
+    Moves up to batch_size events older than cutoff from one event table
+    into segment files, inside the caller's transaction. The paths of the
+    files written are appended to written, so the caller can remove them
+    if the transaction fails. Returns the number of events moved.
+    """
+    table = TABLES[event_type]
+    rows = connection.execute(
+        select(table).where(table.c.timestamp < cutoff).order_by(table.c.id).limit(batch_size).with_for_update()
+    ).mappings().all()
+    if not rows:
+        return 0
+
+    days = {}
+    for row in rows:
+        days.setdefault(row["timestamp"].date(), []).append(dict(row))
+
+    segments = []
+    for day, day_rows in days.items():
+        path = segment_path(event_type, day, day_rows[0]["id"], day_rows[-1]["id"])
+        written.append(path)
+        write_segment(os.path.join(directory, path), day_rows)
+        segments.append({
+            "event_type": event_type,
+            "path": path,
+            "first_timestamp": min(row["timestamp"] for row in day_rows),
+            "last_timestamp": max(row["timestamp"] for row in day_rows),
+            "first_id": day_rows[0]["id"],
+            "last_id": day_rows[-1]["id"],
+            "rows": len(day_rows),
+            "device_counts": dict(Counter(row["device_id"] for row in day_rows))
+        })
+
+    connection.execute(SEGMENTS.insert(), segments)
+    connection.execute(delete(table).where(table.c.id.in_([row["id"] for row in rows])))
+    return len(rows)
+
+
+def enforce(engine, directory, max_age_days, batch_size=10000, stopping=None):
+    """
+    Archives the events of each table in max_age_days that are older than
+    its number of days, one batch per transaction. Returns the number of
+    events moved per type.
+    """
+    moved = {}
+    for event_type, days in max_age_days.items():
+        cutoff = datetime.now() - timedelta(days=days)
+        moved[event_type] = 0
+        while stopping is None or not stopping.is_set():
+            written = []
+            try:
+                with engine.begin() as connection:
+                    count = archive_batch(connection, directory, event_type, cutoff, batch_size, written)
+            except Exception:
+                for path in written:
+                    if os.path.exists(os.path.join(directory, path)):
+                        os.remove(os.path.join(directory, path))
+                raise
+            moved[event_type] += count
+            if count < batch_size:
+                break
+        if moved[event_type]:
+            logger.info(f"Archived {moved[event_type]} {event_type} events older than {cutoff}")
+    return moved
+
+
+def find_segments(connection, event_type, start=None, end=None, after_id=None):
+    """
+    Paths of the segments that can hold events of the given type between
+    start and end with an id above after_id. The others are never opened.
+    """
+    query = select(SEGMENTS.c.path).where(SEGMENTS.c.event_type == event_type)
+    if start is not None:
+        query = query.where(SEGMENTS.c.last_timestamp >= start)
+    if end is not None:
+        query = query.where(SEGMENTS.c.first_timestamp < end)
+    if after_id is not None:
+        query = query.where(SEGMENTS.c.last_id > after_id)
+    return connection.execute(query.order_by(SEGMENTS.c.first_id)).scalars().all()
+
+
+def read_segment(path, fields, start=None, end=None, after_id=None):
+    """
+    Yields the given fields plus the id of the events in a segment that are
+    between start and end and above after_id, in id order, like the rows
+    of an event query. Timestamps stay ISO strings, which compare in time
+    order.
+    """
+    start = start.isoformat() if start is not None else None
+    end = end.isoformat() if end is not None else None
+    with gzip.open(path, "rb") as segment:
+        for line in segment:
+            row = loads(line)
+            if start is not None and row["timestamp"] < start:
+                continue
+            if end is not None and row["timestamp"] >= end:
+                continue
+            if after_id is not None and row["id"] <= after_id:
+                continue
+            yield tuple(row[name] for name in fields) + (row["id"],)
+
+
+def read_segments(directory, paths, fields, start=None, end=None, after_id=None):
+    """ Events of several segments, merged in id order. Files are opened as the result is iterated """
+    return heapq.merge(
+        *(read_segment(os.path.join(directory, path), fields, start, end, after_id) for path in paths),
+        key=itemgetter(-1)
+    )
+
+
+def archived_totals(connection):
+    """ Number of archived events of each type """
+    rows = connection.execute(
+        select(SEGMENTS.c.event_type, func.sum(SEGMENTS.c.rows)).group_by(SEGMENTS.c.event_type)
+    ).all()
+    return {event_type: int(total) for event_type, total in rows}
+
+
+def archived_device_counts(connection, event_type):
+    """ Number of archived events of each device of one type """
+    counts = Counter()
+    for device_counts in connection.execute(
+        select(SEGMENTS.c.device_counts).where(SEGMENTS.c.event_type == event_type)
+    ).scalars():
+        counts.update(device_counts)
+    return counts
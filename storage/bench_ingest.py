@@ -0,0 +1,91 @@
+""" Compares ingest throughput of per-message ORM commits and batched inserts on a SQLite file """
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from models import Base, temperatureEvent, motionEvent
+from ingest import write_batch
+
+N = 5000
+BATCH_SIZES = (50, 500)
+
+
+def make_messages(n):
+    msgs = []
+    for i in range(n):
+        if i % 2:
+            msgs.append({
+                "type": "temperature",
+                "datetime": "2025-01-09T10:30:00",
+                "payload": {"trace_id": i, "device_id": f"thermostat-{i % 50:03d}",
+                            "temperature": 22.5, "event_type": "temperature"}
+            })
+        else:
+            msgs.append({
+                "type": "motion",
+                "datetime": "2025-01-09T10:45:00",
+                "payload": {"trace_id": i, "device_id": f"motion-sensor-{i % 50:03d}",
+                            "room": "Living Room", "motion_intensity": 75}
+            })
+    return msgs
+
+
+def fresh_engine(path):
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}")
+
+    # Full fsync on commit, closer to what a MySQL commit costs
+    @event.listens_for(engine, "connect")
+    def set_sync(connection, _):
+        connection.execute("PRAGMA synchronous=FULL")
+
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def per_message(engine, msgs):
+    """ The old consumer loop, one session and commit per message """
+    session_maker = sessionmaker(bind=engine)
+    for msg in msgs:
+        payload = msg["payload"]
+        session = session_maker()
+        timestamp = datetime.strptime(msg['datetime'], "%Y-%m-%dT%H:%M:%S")
+        if msg["type"] == "temperature":
+            session.add(temperatureEvent(device_id=payload['device_id'], temperature=payload['temperature'],
+                                         timestamp=timestamp, event_type=payload['event_type'],
+                                         trace_id=payload['trace_id']))
+        else:
+            session.add(motionEvent(device_id=payload['device_id'], room=payload['room'],
+                                    motion_intensity=payload['motion_intensity'], timestamp=timestamp,
+                                    trace_id=payload['trace_id']))
+        session.commit()
+        session.close()
+
+
+def batched(batch_size):
+    def run(engine, msgs):
+        for start in range(0, len(msgs), batch_size):
+            with engine.begin() as connection:
+                write_batch(connection, msgs[start:start + batch_size])
+    return run
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else N
+    msgs = make_messages(n)
+    path = os.path.join(tempfile.gettempdir(), 'bench_ingest.sqlite')
+
+    runs = [("per message", per_message)] + [(f"batch of {size}", batched(size)) for size in BATCH_SIZES]
+    print(f"{'mode':<16}{'events/s':>12}")
+    for name, run in runs:
+        engine = fresh_engine(path)
+        start = time.perf_counter()
+        run(engine, msgs)
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+        print(f"{name:<16}{n / elapsed:>12.0f}")
+    os.remove(path)
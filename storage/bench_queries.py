@@ -0,0 +1,70 @@
+""" Measures one-hour range query latency against table size, with and without the models.py indexes """
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, select
+from models import temperatureEvent
+
+SIZES = (10000, 100000, 500000)
+QUERIES = 20
+START = datetime(2025, 1, 1)
+
+
+def populate(engine, size, offset):
+    """ Adds readings one second apart, continuing from `offset` """
+    table = temperatureEvent.__table__
+    with engine.begin() as connection:
+        for chunk in range(offset, size, 50000):
+            connection.execute(table.insert(), [
+                {"device_id": f"thermostat-{i % 200:03d}", "temperature": 20,
+                 "timestamp": START + timedelta(seconds=i), "event_type": "temperature", "trace_id": i}
+                for i in range(chunk, min(chunk + 50000, size))
+            ])
+
+
+def range_query_ms(engine, size):
+    """ Average time of a one-hour range query spread over the table """
+    elapsed = 0
+    with engine.connect() as connection:
+        for i in range(QUERIES):
+            start = START + timedelta(seconds=(size - 3600) * i // QUERIES)
+            begin = time.perf_counter()
+            connection.execute(select(temperatureEvent).where(
+                temperatureEvent.timestamp >= start,
+                temperatureEvent.timestamp < start + timedelta(hours=1)
+            )).all()
+            elapsed += time.perf_counter() - begin
+    return elapsed / QUERIES * 1000
+
+
+def run(indexed, sizes):
+    path = os.path.join(tempfile.gettempdir(), 'bench_queries.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}")
+    table = temperatureEvent.__table__
+    table.create(engine)
+    if not indexed:
+        for index in table.indexes:
+            index.drop(engine)
+
+    results = []
+    rows = 0
+    for size in sizes:
+        populate(engine, size, rows)
+        rows = size
+        results.append(range_query_ms(engine, size))
+    engine.dispose()
+    os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    without = run(False, sizes)
+    with_indexes = run(True, sizes)
+    print(f"{'rows':>10}{'no index ms':>14}{'indexed ms':>14}")
+    for size, slow, fast in zip(sizes, without, with_indexes):
+        print(f"{size:>10}{slow:>14.2f}{fast:>14.2f}")
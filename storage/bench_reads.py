@@ -0,0 +1,72 @@
+""" Compares rows/second of the ORM read path and the Core tuple + fast JSON path on a SQLite file """
+import os
+import sys
+import json
+import time
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from models import temperatureEvent
+import orjson
+
+N = 200000
+START = datetime(2025, 1, 1)
+END = START + timedelta(days=365)
+
+
+def populate(engine, n):
+    table = temperatureEvent.__table__
+    table.create(engine)
+    with engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {"device_id": f"thermostat-{i % 200:03d}", "temperature": 20,
+             "timestamp": START + timedelta(seconds=i), "event_type": "temperature", "trace_id": i}
+            for i in range(n)
+        ])
+
+
+def orm_path(engine, fields):
+    """ ORM objects, to_dict() and json.dumps, as the endpoints used to do """
+    session = sessionmaker(bind=engine)()
+    events = session.query(temperatureEvent).filter(
+        temperatureEvent.timestamp >= START,
+        temperatureEvent.timestamp < END
+    ).all()
+    body = json.dumps([event.to_dict() for event in events])
+    session.close()
+    return body
+
+
+def core_path(engine, fields):
+    """ Plain tuples of the selected columns, encoded with orjson """
+    table = temperatureEvent.__table__
+    query = select(*(table.c[name] for name in fields)).where(table.c.timestamp >= START, table.c.timestamp < END)
+    with engine.connect() as connection:
+        rows = connection.execute(query).all()
+    return orjson.dumps([dict(zip(fields, row)) for row in rows])
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else N
+    path = os.path.join(tempfile.gettempdir(), 'bench_reads.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}")
+    populate(engine, n)
+
+    all_fields = [column.name for column in temperatureEvent.__table__.columns]
+    runs = (
+        ("orm + to_dict", orm_path, all_fields),
+        ("core + orjson", core_path, all_fields),
+        ("core, 2 fields", core_path, ["timestamp", "temperature"]),
+    )
+    print(f"{'path':<16}{'rows/s':>12}{'bytes':>12}")
+    for name, run, fields in runs:
+        start = time.perf_counter()
+        body = run(engine, fields)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16}{n / elapsed:>12.0f}{len(body):>12}")
+
+    engine.dispose()
+    os.remove(path)
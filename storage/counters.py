@@ -0,0 +1,89 @@
+from collections import Counter
+from sqlalchemy import select, func, delete
+from sqlalchemy.dialects import mysql, sqlite
+from models import temperatureEvent, motionEvent, eventCount
+from archive import archived_device_counts
+
+COUNTS = eventCount.__table__
+MODELS = {
+    "temperature": temperatureEvent,
+    "motion": motionEvent,
+}
+# device_id of the row that holds the total for an event type
+TOTAL = ""
+
+
+def upsert(dialect_name):
+    """ INSERT that adds to an existing counter, for MySQL and SQLite """
+    if dialect_name == "mysql":
+        statement = mysql.insert(COUNTS)
+        return statement.on_duplicate_key_update(count=COUNTS.c["count"] + statement.inserted["count"])
+    if dialect_name == "sqlite":
+        statement = sqlite.insert(COUNTS)
+        return statement.on_conflict_do_update(
+            index_elements=["event_type", "device_id"],
+            set_={"count": COUNTS.c["count"] + statement.excluded["count"]}
+        )
+    raise ValueError(f"Counters are not supported on {dialect_name}")
+
+
+def update_counters(connection, rows_by_type):
+    """ Adds newly stored event rows to the counters, inside the caller's transaction """
+    counts = []
+    for event_type, rows in rows_by_type.items():
+        if not rows:
+            continue
+        counts.append({"event_type": event_type, "device_id": TOTAL, "count": len(rows)})
+        devices = Counter(row["device_id"] for row in rows)
+        counts.extend({"event_type": event_type, "device_id": device_id, "count": count}
+                      for device_id, count in devices.items())
+    if counts:
+        connection.execute(upsert(connection.dialect.name), counts)
+
+
+def read_totals(connection):
+    """ Stored number of events of each type, one primary key lookup per type """
+    rows = connection.execute(
+        select(COUNTS.c.event_type, COUNTS.c["count"]).where(COUNTS.c.device_id == TOTAL)
+    ).all()
+    totals = {event_type: 0 for event_type in MODELS}
+    totals.update(dict(rows))
+    return totals
+
+
+def read_devices(connection, event_type=None):
+    query = select(COUNTS.c.event_type, COUNTS.c.device_id, COUNTS.c["count"]).where(COUNTS.c.device_id != TOTAL)
+    if event_type is not None:
+        query = query.where(COUNTS.c.event_type == event_type)
+    return connection.execute(query.order_by(COUNTS.c.event_type, COUNTS.c.device_id)).mappings().all()
+
+
+def reconcile(connection):
+    """
+    Replaces the counters with real counts of the event tables, inside the
+    caller's transaction. The counter rows are locked first, so on MySQL
+    writers that commit in the meantime wait and add their rows on top of
+    the new counts. Archived events still count. Returns the stored and
+    actual total of each type.
+    """
+    connection.execute(select(COUNTS.c.event_type).with_for_update()).all()
+    stored = read_totals(connection)
+
+    counts = []
+    result = {}
+    for event_type, model in MODELS.items():
+        table = model.__table__
+        devices = archived_device_counts(connection, event_type)
+        devices.update(dict(connection.execute(
+            select(table.c.device_id, func.count()).group_by(table.c.device_id)
+        ).all()))
+        devices = sorted(devices.items())
+        total = sum(count for _, count in devices)
+        result[event_type] = {"stored": stored[event_type], "actual": total}
+        counts.append({"event_type": event_type, "device_id": TOTAL, "count": total})
+        counts.extend({"event_type": event_type, "device_id": device_id, "count": count}
+                      for device_id, count in devices)
+
+    connection.execute(delete(COUNTS))
+    connection.execute(COUNTS.insert(), counts)
+    return result
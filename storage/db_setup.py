@@ -3,15 +3,17 @@ import os
 import sys
 import time
 import logging
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, select, delete, event, func, tuple_
 from sqlalchemy.orm import sessionmaker
-from models import Base
+from models import Base, temperatureEvent, motionEvent
+from rollups import BUCKETS as ROLLUP_BUCKETS, VALUE_FIELDS, update_rollups
+from counters import COUNTS as COUNTS_TABLE, reconcile
 
 logger = logging.getLogger('basicLogger')
 
 # Use absolute paths
 ENV = os.environ.get('ENV', 'dev')
-CONFIG_PATH = "/app/config"  # Absolute path, not relative
+CONFIG_PATH = os.environ.get('CONFIG_PATH', '/app/config')
 FULL_CONFIG_PATH = os.path.join(CONFIG_PATH, ENV, 'storage')
 app_conf_file = os.path.join(FULL_CONFIG_PATH, 'storage_app_conf.yaml')
 
@@ -22,49 +24,193 @@ print(f"File exists: {os.path.exists(app_conf_file)}", file=sys.stderr)
 with open(app_conf_file, "r") as f:
     app_config = yaml.safe_load(f.read())
 
-# Updated to match your config file structure
-db_host = app_config["datastore"]["hostname"]
-db_user = app_config["datastore"]["user"]
-db_password = app_config["datastore"]["password"]
-db_name = app_config["datastore"]["db"]
-db_port = 3306  # Default MySQL port
-
-DB_URL = f"mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-
-max_retries = 20
-retry_count = 0
-engine = None
-
-while retry_count < max_retries:
-    try:
-        logger.info(f"Attempting to connect to DB: {DB_URL}")
-        engine = create_engine(DB_URL)
-        # Test the connection
-        with engine.connect() as connection:
-            logger.info("Database connection successful")
-            break
-    except Exception as e:
-        retry_count += 1
-        logger.error(f"DB connection attempt {retry_count}/{max_retries} failed: {str(e)}")
-        if retry_count < max_retries:
-            logger.info(f"Retrying in 5 seconds")
-            time.sleep(5)
-        else:
-            logger.error("Max retries reached, could not connect to database")
-            raise
-
-logger.info(f"Connecting to database at {DB_URL}")
-engine = create_engine(DB_URL)
+datastore = app_config["datastore"]
+
+def mysql_engine(datastore):
+    """ MySQL engine with the pool settings from the datastore config """
+    db_host = os.environ.get('DB_HOST', datastore["hostname"])
+    db_port = os.environ.get('DB_PORT', datastore.get("port", 3306))
+    db_user = os.environ.get('DB_USER', datastore["user"])
+    db_password = os.environ.get('DB_PASSWORD', datastore["password"])
+    db_name = os.environ.get('DB_NAME', datastore["db"])
+
+    pool = datastore.get("pool", {})
+    return create_engine(
+        f"mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}",
+        pool_size=pool.get("size", 5),
+        max_overflow=pool.get("max_overflow", 10),
+        pool_timeout=pool.get("timeout_s", 30),
+        # Checks connections before handing them out, so ones the server
+        # closed while idle are replaced instead of failing a request
+        pool_pre_ping=pool.get("pre_ping", True),
+        # Below MySQL's wait_timeout, so idle connections are renewed first
+        pool_recycle=pool.get("recycle_s", 1800)
+    )
+
+def sqlite_engine(datastore):
+    """
+    SQLite engine for running storage on a single node. The database is
+    put in WAL mode so readers don't block the consumers' writes and the
+    other way around, with one writer at a time across all processes.
+    """
+    path = datastore.get("path", "/app/data/storage.sqlite")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    pragmas = datastore.get("sqlite", {})
+    busy_timeout_ms = pragmas.get("busy_timeout_ms", 5000)
+    pool = datastore.get("pool", {})
+    engine = create_engine(
+        f"sqlite:///{path}",
+        pool_size=pool.get("size", 5),
+        max_overflow=pool.get("max_overflow", 10),
+        pool_timeout=pool.get("timeout_s", 30),
+        connect_args={"check_same_thread": False, "timeout": busy_timeout_ms / 1000}
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(connection, _):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # NORMAL only syncs at checkpoints in WAL mode, a power loss can
+        # lose the last commits but never corrupts the database
+        cursor.execute(f"PRAGMA synchronous={pragmas.get('synchronous', 'NORMAL')}")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA cache_size=-{int(pragmas.get('cache_size_kb', 65536))}")
+        cursor.execute(f"PRAGMA mmap_size={int(pragmas.get('mmap_size_mb', 256)) * 1024 * 1024}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return engine
+
+ENGINES = {
+    "mysql": mysql_engine,
+    "sqlite": sqlite_engine,
+}
+
+backend = datastore.get("backend", "mysql")
+engine = ENGINES[backend](datastore)
 Base.metadata.bind = engine
-inspector = inspect(engine)
 
-existing_tables = inspector.get_table_names()
-logger.info(f"Found existing tables: {existing_tables}")
+def wait_for_database(engine, max_retries=20):
+    """ Waits for the database to accept connections, raises after max_retries attempts """
+    for attempt in range(1, max_retries + 1):
+        try:
+            logger.info(f"Attempting to connect to DB: {engine.url.render_as_string(hide_password=True)}")
+            # Test the connection
+            with engine.connect():
+                logger.info("Database connection successful")
+                return
+        except Exception as e:
+            logger.error(f"DB connection attempt {attempt}/{max_retries} failed: {str(e)}")
+            if attempt < max_retries:
+                logger.info(f"Retrying in 5 seconds")
+                time.sleep(5)
+            else:
+                logger.error("Max retries reached, could not connect to database")
+                raise
+
+def collapse_duplicates(connection, table, columns, chunk_size=1000):
+    """
+    Deletes every row that repeats the values of an earlier row (lower id)
+    in the given columns, so a unique index can be built on them. Returns
+    the number of rows deleted.
+    """
+    keys = [table.c[name] for name in columns]
+    groups = connection.execute(
+        select(*keys, func.min(table.c.id)).group_by(*keys).having(func.count() > 1)
+    ).all()
+    deleted = 0
+    for start in range(0, len(groups), chunk_size):
+        chunk = groups[start:start + chunk_size]
+        result = connection.execute(
+            delete(table)
+            .where(tuple_(*keys).in_([tuple(group[:-1]) for group in chunk]))
+            .where(table.c.id.not_in([group[-1] for group in chunk]))
+        )
+        deleted += result.rowcount
+    return deleted
+
+def migrate_indexes(engine):
+    """
+    Adds indexes from models.py that are missing on existing tables. Rows
+    that would break a unique index are deleted first, keeping the first
+    of each, and the event counters are recounted if any were. Raises if an
+    index still can't be built, storage doesn't run without them.
+    """
+    inspector = inspect(engine)
+    collapsed = False
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique:
+                columns = [column.name for column in index.columns]
+                with engine.begin() as connection:
+                    deleted = collapse_duplicates(connection, table, columns)
+                if deleted:
+                    logger.warning(f"Deleted {deleted} rows of {table.name} repeating the {columns} of an earlier row")
+                    collapsed = True
+            logger.info(f"Creating index {index.name} on {table.name}")
+            index.create(engine)
+
+    if collapsed:
+        logger.info("Recounting stored events for the event counters")
+        with engine.begin() as connection:
+            reconcile(connection)
+
+
+def backfill_rollups(engine, buckets, chunk_size=10000):
+    """ Rolls up the events stored before the given rollup tables existed """
+    logger.info(f"Backfilling {buckets} rollup tables from stored events")
+    with engine.begin() as connection:
+        for event_type, model in (("temperature", temperatureEvent), ("motion", motionEvent)):
+            table = model.__table__
+            last_id = 0
+            # Paged by id rather than streamed, so the same connection can write in between
+            while True:
+                rows = connection.execute(
+                    select(table.c.id, table.c.device_id, table.c.timestamp, table.c[VALUE_FIELDS[event_type]])
+                    .where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size)
+                ).mappings().all()
+                if not rows:
+                    break
+                update_rollups(connection, {event_type: rows}, buckets)
+                last_id = rows[-1]["id"]
+
+def setup_database(engine):
+    """
+    Creates missing tables and indexes. Rollups and counters are only
+    maintained as events come in, so new rollup and counter tables are
+    filled from the events already stored.
+    """
+    existing_tables = inspect(engine).get_table_names()
+    logger.info(f"Found existing tables: {existing_tables}")
+
+    missing_tables = [name for name in Base.metadata.tables if name not in existing_tables]
+    if missing_tables:
+        logger.info(f"Creating missing tables: {missing_tables}")
+        Base.metadata.create_all(engine)
+    else:
+        logger.info("All tables already exist, not creating any")
+
+    migrate_indexes(engine)
+
+    new_rollups = [bucket for bucket, table in ROLLUP_BUCKETS.items() if table.name in missing_tables]
+    if new_rollups and "temperature" in existing_tables:
+        backfill_rollups(engine, new_rollups)
+
+    if COUNTS_TABLE.name in missing_tables and "temperature" in existing_tables:
+        logger.info("Counting stored events for the event counters")
+        with engine.begin() as connection:
+            reconcile(connection)
 
-if not inspector.has_table("temperature") or not inspector.has_table("motion"):
-    logger.info("Creating missing tables")
-    Base.metadata.create_all(engine)
-else:
-    logger.info("All tables already exist, not creating any")
+# serve.py sets this once it has set up the database, so its worker and
+# ingestion processes don't connect, inspect and migrate it all over again
+if os.environ.get('STORAGE_SCHEMA_READY') != '1':
+    wait_for_database(engine)
+    setup_database(engine)
 
 DB_SESSION = sessionmaker(bind=engine)
\ No newline at end of file
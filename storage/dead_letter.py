@@ -0,0 +1,36 @@
+import os
+import json
+import base64
+from datetime import datetime
+from threading import Lock
+
+
+class DeadLetterFile:
+    """
+    Appends messages that can't be stored to an NDJSON file, one line per
+    message with the raw value in base64, the error, and where in the topic
+    it came from, so they can be inspected and replayed later.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def add(self, consumer, message, error):
+        record = {
+            "time": datetime.now().isoformat(),
+            "consumer": consumer,
+            "partition": getattr(message, "partition_id", None),
+            "offset": message.offset,
+            "error": f"{type(error).__name__}: {error}",
+            "value": base64.b64encode(message.value).decode('ascii')
+        }
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        # One write per line on a file opened for appending, so lines from
+        # consumer processes sharing the file don't interleave
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(line)
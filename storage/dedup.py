@@ -0,0 +1,62 @@
+import multiprocessing
+from collections import OrderedDict
+from threading import Lock
+
+
+class TraceIdCache:
+    """
+    The most recently stored trace IDs, up to max_size of them, in LRU
+    order. Replayed messages usually arrive soon after the original, so this
+    catches most of them without a database round trip. Anything older is
+    left to the unique trace_id index.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, trace_id):
+        with self._lock:
+            if trace_id in self._ids:
+                self._ids.move_to_end(trace_id)
+                return True
+            return False
+
+    def add(self, trace_ids):
+        with self._lock:
+            for trace_id in trace_ids:
+                self._ids[trace_id] = None
+                self._ids.move_to_end(trace_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+
+class DedupStats:
+    """ Dedup counters, kept in shared memory so consumer processes can update them too """
+
+    def __init__(self):
+        self._messages = multiprocessing.Value('q', 0)
+        self._cache_hits = multiprocessing.Value('q', 0)
+        self._db_duplicates = multiprocessing.Value('q', 0)
+
+    def record(self, messages, cache_hits, db_duplicates):
+        for counter, amount in ((self._messages, messages), (self._cache_hits, cache_hits),
+                                (self._db_duplicates, db_duplicates)):
+            with counter.get_lock():
+                counter.value += amount
+
+    def to_dict(self):
+        messages = self._messages.value
+        cache_hits = self._cache_hits.value
+        db_duplicates = self._db_duplicates.value
+        return {
+            "messages": messages,
+            "cache_hits": cache_hits,
+            "db_duplicates": db_duplicates,
+            "cache_hit_rate": cache_hits / messages if messages else 0.0,
+            "duplicate_rate": (cache_hits + db_duplicates) / messages if messages else 0.0
+        }
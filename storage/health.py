@@ -0,0 +1,63 @@
+import time
+import multiprocessing
+
+STATES = ("starting", "running", "retrying", "restarting", "stopped")
+
+
+class ConsumerHealth:
+    """
+    Liveness and progress of one consumer worker, kept in shared memory so
+    consumer processes can report it too. Only the worker itself writes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._state = multiprocessing.Value('i', 0, lock=False)
+        self._last_poll = multiprocessing.Value('d', 0.0, lock=False)
+        self._last_commit = multiprocessing.Value('d', 0.0, lock=False)
+        self._messages = multiprocessing.Value('q', 0, lock=False)
+        self._lag = multiprocessing.Value('q', -1, lock=False)
+        self._restarts = multiprocessing.Value('q', 0, lock=False)
+        self._retries = multiprocessing.Value('q', 0, lock=False)
+        self._quarantined = multiprocessing.Value('q', 0, lock=False)
+
+    def set_state(self, state):
+        self._state.value = STATES.index(state)
+
+    def polled(self):
+        self._last_poll.value = time.time()
+
+    def committed(self, messages):
+        self._last_commit.value = time.time()
+        self._messages.value += messages
+
+    def set_lag(self, lag):
+        self._lag.value = lag
+
+    def add_restarts(self, count):
+        self._restarts.value += count
+
+    def add_retries(self, count):
+        self._retries.value += count
+
+    def add_quarantined(self, count):
+        self._quarantined.value += count
+
+    def to_dict(self, stall_s=30):
+        """ The worker is alive if it is running and has polled Kafka within the last stall_s seconds """
+        now = time.time()
+        state = STATES[self._state.value]
+        last_poll = self._last_poll.value
+        last_commit = self._last_commit.value
+        return {
+            "name": self.name,
+            "state": state,
+            "alive": state in ("running", "retrying") and now - last_poll < stall_s,
+            "seconds_since_poll": round(now - last_poll, 3) if last_poll else None,
+            "seconds_since_commit": round(now - last_commit, 3) if last_commit else None,
+            "messages": self._messages.value,
+            "lag": self._lag.value if self._lag.value >= 0 else None,
+            "restarts": self._restarts.value,
+            "db_retries": self._retries.value,
+            "quarantined": self._quarantined.value
+        }
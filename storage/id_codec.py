@@ -0,0 +1,32 @@
+import sys
+import zlib
+import base64
+from array import array
+from operator import sub
+from itertools import accumulate, chain
+
+# Compact encoding for large sets of trace IDs.
+#
+# The IDs are sorted and replaced by the differences between neighbours
+# (the first one is kept as is), written as little endian int64s and
+# deflated. Snowflake trace IDs that are close in time differ only in their
+# low bits, so most of each 8 byte delta is zeros and compresses away.
+# The result is base64 encoded to travel inside a JSON response.
+
+ENCODING = "delta-int64-le-zlib-base64"
+
+
+def encode_ids(ids):
+    ids = sorted(ids)
+    deltas = array('q', map(sub, ids, chain((0,), ids)))
+    if sys.byteorder != 'little':
+        deltas.byteswap()
+    return base64.b64encode(zlib.compress(deltas.tobytes())).decode('ascii')
+
+
+def decode_ids(data):
+    deltas = array('q')
+    deltas.frombytes(zlib.decompress(base64.b64decode(data)))
+    if sys.byteorder != 'little':
+        deltas.byteswap()
+    return list(accumulate(deltas))
@@ -0,0 +1,335 @@
+import time
+import logging
+import random
+from threading import Event
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError, OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
+from models import temperatureEvent, motionEvent
+from rollups import update_rollups
+from counters import update_counters
+
+logger = logging.getLogger('basicLogger')
+event_logger = logging.getLogger('basicLogger.events')
+
+TABLES = {
+    "temperature": temperatureEvent.__table__,
+    "motion": motionEvent.__table__,
+}
+
+
+NUMBER = (int, float)
+
+
+def field(payload, name, types):
+    """ A payload field, which must be present and of one of the given types """
+    value = payload.get(name)
+    # bool is an int, but true is not a reading
+    if isinstance(value, bool) or not isinstance(value, types):
+        raise ValueError(f"Field {name} is {value!r}")
+    return value
+
+
+def event_row(msg):
+    """
+    Turns a decoded event message into a row for its table. Raises
+    ValueError if a field is missing or of the wrong type, since the insert
+    would otherwise drop the row or store a default in its place.
+    """
+    payload = msg["payload"]
+    # Messages always carry "%Y-%m-%dT%H:%M:%S", which fromisoformat parses much faster than strptime
+    timestamp = datetime.fromisoformat(msg["datetime"])
+
+    if msg["type"] == "temperature":
+        return {
+            "device_id": field(payload, 'device_id', str),
+            "temperature": field(payload, 'temperature', NUMBER),
+            "timestamp": timestamp,
+            "event_type": field(payload, 'event_type', str),
+            "trace_id": field(payload, 'trace_id', int)
+        }
+    if msg["type"] == "motion":
+        return {
+            "device_id": field(payload, 'device_id', str),
+            "room": field(payload, 'room', str),
+            "motion_intensity": field(payload, 'motion_intensity', NUMBER),
+            "timestamp": timestamp,
+            "trace_id": field(payload, 'trace_id', int)
+        }
+    raise ValueError(f"Unknown event type {msg['type']}")
+
+
+def insert_ignore(table):
+    """ INSERT that skips rows whose trace_id is already stored """
+    return table.insert().prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+
+INSERTS = {event_type: insert_ignore(table) for event_type, table in TABLES.items()}
+
+
+def write_batch(connection, msgs, rollups=False, counters=False):
+    """
+    Inserts a batch of decoded event messages with one executemany per
+    table, and adds them to the rollup tables and event counters if those
+    are enabled. Returns the number of rows that were already stored. The
+    caller owns the transaction.
+
+    With rollups or counters enabled, rows that are already stored are
+    looked up and left out first, and the others are inserted without
+    IGNORE, so every row the aggregates count is in the table. A row that
+    another writer stored since the lookup makes the insert raise
+    IntegrityError; retried in a new transaction, its lookup finds it.
+    """
+    rows = {event_type: [] for event_type in TABLES}
+    for msg in msgs:
+        rows[msg["type"]].append(event_row(msg))
+    return write_rows(connection, rows, rollups, counters)
+
+
+def stored_trace_ids(connection, table, rows):
+    """ Trace IDs of the given rows that are already in the table """
+    return set(connection.execute(
+        select(table.c.trace_id).where(table.c.trace_id.in_([row["trace_id"] for row in rows]))
+    ).scalars())
+
+
+def write_rows(connection, rows, rollups=False, counters=False):
+    """ write_batch for rows that were already built from their messages, by event type """
+    rows = dict(rows)
+    duplicates = 0
+    for event_type, table_rows in rows.items():
+        if not table_rows:
+            continue
+        statement = INSERTS[event_type]
+        if rollups or counters:
+            # Replays must not be counted twice, so they are filtered out
+            # here rather than left to the insert
+            table = TABLES[event_type]
+            statement = table.insert()
+            stored = stored_trace_ids(connection, table, table_rows)
+            if stored:
+                new_rows = [row for row in table_rows if row["trace_id"] not in stored]
+                duplicates += len(table_rows) - len(new_rows)
+                table_rows = rows[event_type] = new_rows
+                if not table_rows:
+                    continue
+
+        result = connection.execute(statement, table_rows)
+        duplicates += len(table_rows) - result.rowcount
+        event_logger.info("Stored %s %s events", result.rowcount, event_type)
+
+    if rollups:
+        update_rollups(connection, rows)
+    if counters:
+        update_counters(connection, rows)
+    return duplicates
+
+
+def is_transient(error):
+    """
+    Whether a database error is likely to go away on a retry: lost or
+    refused connections, lock timeouts and deadlocks, pool timeouts.
+    """
+    if isinstance(error, PoolTimeoutError):
+        return True
+    if not isinstance(error, DBAPIError):
+        return False
+    return isinstance(error, (OperationalError, InterfaceError)) or error.connection_invalidated
+
+
+class BatchConsumer:
+    """
+    Collects messages from a pykafka consumer into batches of up to
+    max_size messages, or whatever arrived within max_wait_ms of the first
+    one. Each batch is written in one transaction and the Kafka offsets are
+    only committed once that transaction has committed, so a crash replays
+    the batch rather than losing it.
+
+    The consumer must be created with consumer_timeout_ms set, so that an
+    idle topic still lets a partial batch be flushed on time and `stopping`
+    is noticed. The consumer holds one database connection while it runs.
+    Once `stopping` is set, the batch in progress is flushed and the Kafka
+    consumer is stopped.
+
+    Redelivered messages are dropped if their trace ID is in `cache`, and
+    otherwise ignored by the insert, so replaying a batch is harmless.
+
+    Messages that can't be decoded or lack a field, or whose row can't be
+    stored, are written to `dead_letter` and skipped. Transient database
+    errors are retried up to max_retries times with exponential backoff,
+    after which run() raises without committing the batch, for the caller
+    to start over with a new consumer.
+    """
+
+    def __init__(self, consumer, engine, decode, max_size=500, max_wait_ms=200, stopping=None, name="consumer",
+                 cache=None, stats=None, rollups=False, counters=False, dead_letter=None, health=None,
+                 max_retries=5, retry_backoff_s=0.5, max_retry_backoff_s=30, lag_interval_s=10):
+        self.consumer = consumer
+        self.engine = engine
+        self.decode = decode
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.stopping = stopping or Event()
+        self.name = name
+        self.cache = cache
+        self.stats = stats
+        self.rollups = rollups
+        self.counters = counters
+        self.dead_letter = dead_letter
+        self.health = health
+        self.max_retries = max_retries
+        self.retry_backoff_s = retry_backoff_s
+        self.max_retry_backoff_s = max_retry_backoff_s
+        self.lag_interval_s = lag_interval_s
+        self.batches = 0
+        self.messages = 0
+
+    def quarantine(self, message, error):
+        logger.error(f"{self.name} quarantined message at offset {message.offset}: {error}")
+        if self.dead_letter is not None:
+            self.dead_letter.add(self.name, message, error)
+        if self.health is not None:
+            self.health.add_quarantined(1)
+
+    def parse(self, batch):
+        """
+        Builds the rows of a batch by event type, along with the message of
+        each row, leaving out replays and messages that can't be decoded.
+        Returns the rows, the messages, their trace IDs and the number of
+        replays.
+        """
+        rows = {event_type: [] for event_type in TABLES}
+        messages = {event_type: [] for event_type in TABLES}
+        trace_ids = set()
+        replays = 0
+        for message in batch:
+            try:
+                msg = self.decode(message.value)
+                row = event_row(msg)
+            except Exception as e:
+                self.quarantine(message, e)
+                continue
+            trace_id = row["trace_id"]
+            if trace_id in trace_ids or (self.cache is not None and trace_id in self.cache):
+                replays += 1
+                continue
+            trace_ids.add(trace_id)
+            rows[msg["type"]].append(row)
+            messages[msg["type"]].append(message)
+        return rows, messages, trace_ids, replays
+
+    def write(self, connection, rows, messages):
+        """
+        Writes the rows of a batch in one transaction, retrying transient
+        errors. If the batch fails for any other reason, from the database
+        refusing it to a row the rollups can't add up, the rows are written
+        one at a time to find and quarantine the bad ones.
+        Returns the number of rows that were already stored and the trace
+        IDs of the quarantined rows.
+        """
+        attempt = 0
+        while True:
+            try:
+                with connection.begin():
+                    return write_rows(connection, rows, self.rollups, self.counters), set()
+            except Exception as e:
+                if not is_transient(e):
+                    logger.warning(f"{self.name} batch was refused, writing its rows one at a time: {e!r}")
+                    return self.write_each(connection, rows, messages)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retry_wait(attempt, e)
+
+    def write_each(self, connection, rows, messages):
+        duplicates = 0
+        quarantined = set()
+        for event_type, table_rows in rows.items():
+            for row, message in zip(table_rows, messages[event_type]):
+                try:
+                    with connection.begin():
+                        duplicates += write_rows(connection, {event_type: [row]}, self.rollups, self.counters)
+                except Exception as e:
+                    if is_transient(e):
+                        raise
+                    self.quarantine(message, e)
+                    quarantined.add(row["trace_id"])
+        return duplicates, quarantined
+
+    def retry_wait(self, attempt, error):
+        # Jittered, so consumers that failed together don't retry together
+        delay = min(self.retry_backoff_s * 2 ** (attempt - 1), self.max_retry_backoff_s) * random.uniform(0.5, 1)
+        logger.warning(f"{self.name} database error, retry {attempt}/{self.max_retries} in {delay:.1f}s: {error}")
+        if self.health is not None:
+            self.health.set_state("retrying")
+            self.health.add_retries(1)
+        # The batch is replayed by whoever takes over the partitions
+        if self.stopping.wait(delay):
+            raise error
+        if self.health is not None:
+            self.health.set_state("running")
+
+    def flush(self, connection, batch):
+        rows, messages, trace_ids, replays = self.parse(batch)
+
+        duplicates = 0
+        if trace_ids:
+            duplicates, quarantined = self.write(connection, rows, messages)
+            trace_ids -= quarantined
+        self.consumer.commit_offsets()
+
+        # Only IDs that are durably stored go in the cache
+        if self.cache is not None:
+            self.cache.add(trace_ids)
+        if self.stats is not None:
+            self.stats.record(len(batch), replays, duplicates)
+        if self.health is not None:
+            self.health.committed(len(batch))
+        self.batches += 1
+        self.messages += len(batch)
+        event_logger.info("%s committed batch of %s messages, offset %s",
+                          self.name, len(batch), batch[-1].offset)
+
+    def update_lag(self):
+        """ Number of messages in the partitions this consumer owns that it hasn't read yet """
+        try:
+            held = self.consumer.held_offsets or {}
+            lag = 0
+            for partition_id, partition in self.consumer.partitions.items():
+                offset = held.get(partition_id, -1)
+                # Negative offsets mean nothing was read from the partition yet
+                lag += max(partition.latest_available_offset() - offset - 1, 0) if offset >= 0 else 0
+            self.health.set_lag(lag)
+        except Exception as e:
+            logger.warning(f"{self.name} could not fetch partition offsets: {e}")
+            self.health.set_lag(-1)
+
+    def run(self):
+        batch = []
+        deadline = None
+        next_lag = time.monotonic()
+        with self.engine.connect() as connection:
+            try:
+                if self.health is not None:
+                    self.health.set_state("running")
+                while not self.stopping.is_set():
+                    message = self.consumer.consume()
+                    if message is not None:
+                        if not batch:
+                            deadline = time.monotonic() + self.max_wait
+                        batch.append(message)
+
+                    if batch and (len(batch) >= self.max_size or time.monotonic() >= deadline):
+                        self.flush(connection, batch)
+                        batch = []
+
+                    if self.health is not None:
+                        self.health.polled()
+                        if time.monotonic() >= next_lag:
+                            self.update_lag()
+                            next_lag = time.monotonic() + self.lag_interval_s
+
+                if batch:
+                    self.flush(connection, batch)
+                logger.info(f"{self.name} stopped after {self.messages} messages in {self.batches} batches")
+            finally:
+                self.consumer.stop()
@@ -1,11 +1,16 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, String, DateTime, func, BigInteger
+from sqlalchemy import Integer, String, DateTime, func, BigInteger, Index, Double, JSON
 
 class Base(DeclarativeBase):
     pass
 
 class temperatureEvent(Base):
     __tablename__ = "temperature"
+    __table_args__ = (
+        Index("ix_temperature_timestamp", "timestamp"),
+        Index("ix_temperature_trace_id", "trace_id", unique=True),
+        Index("ix_temperature_device_id_timestamp", "device_id", "timestamp"),
+    )
 
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     device_id = mapped_column(String(50), nullable=False)
@@ -33,6 +38,11 @@ class temperatureEvent(Base):
 
 class motionEvent(Base):
     __tablename__ = "motion"
+    __table_args__ = (
+        Index("ix_motion_timestamp", "timestamp"),
+        Index("ix_motion_trace_id", "trace_id", unique=True),
+        Index("ix_motion_device_id_timestamp", "device_id", "timestamp"),
+    )
 
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     device_id = mapped_column(String(50), nullable=False)
@@ -56,4 +66,53 @@ class motionEvent(Base):
             "timestamp": self.timestamp.isoformat(),
             "motion_intensity": self.motion_intensity,
             "trace_id": self.trace_id
-        }
\ No newline at end of file
+        }
+
+class RollupMixin:
+    """ Count, sum, min and max of one device's readings in one time bucket """
+    event_type = mapped_column(String(20), primary_key=True)
+    device_id = mapped_column(String(50), primary_key=True)
+    bucket_start = mapped_column(DateTime, primary_key=True)
+    count = mapped_column(BigInteger, nullable=False)
+    sum = mapped_column(Double, nullable=False)
+    min = mapped_column(Double, nullable=False)
+    max = mapped_column(Double, nullable=False)
+
+class minuteRollup(RollupMixin, Base):
+    __tablename__ = "rollup_minute"
+    __table_args__ = (
+        Index("ix_rollup_minute_event_type_bucket_start", "event_type", "bucket_start"),
+    )
+
+class hourRollup(RollupMixin, Base):
+    __tablename__ = "rollup_hour"
+    __table_args__ = (
+        Index("ix_rollup_hour_event_type_bucket_start", "event_type", "bucket_start"),
+    )
+
+class eventCount(Base):
+    """ Number of stored events per type and device, device_id "" holds the total of the type """
+    __tablename__ = "event_counts"
+
+    event_type = mapped_column(String(20), primary_key=True)
+    device_id = mapped_column(String(50), primary_key=True)
+    count = mapped_column(BigInteger, nullable=False)
+
+class archiveSegment(Base):
+    """ A segment file of events moved out of an event table, with the time range and ids it holds """
+    __tablename__ = "archive_segments"
+    __table_args__ = (
+        Index("ix_archive_segments_event_type_first", "event_type", "first_timestamp"),
+    )
+
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    event_type = mapped_column(String(20), nullable=False)
+    path = mapped_column(String(255), nullable=False)
+    first_timestamp = mapped_column(DateTime, nullable=False)
+    last_timestamp = mapped_column(DateTime, nullable=False)
+    first_id = mapped_column(Integer, nullable=False)
+    last_id = mapped_column(Integer, nullable=False)
+    rows = mapped_column(Integer, nullable=False)
+    # Number of events of each device in the segment, for the event counters
+    device_counts = mapped_column(JSON, nullable=False)
+    created = mapped_column(DateTime, nullable=False, server_default=func.now())
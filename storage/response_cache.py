@@ -0,0 +1,93 @@
+import time
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+
+def etag(body):
+    """ Strong ETag of a response body """
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def opaque_tag(tag):
+    """ An entity tag without its weakness indicator """
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def etag_matches(if_none_match, tag):
+    """
+    Whether an If-None-Match header names the given ETag, using the weak
+    comparison RFC 7232 asks for: W/"x" matches "x"
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = opaque_tag(tag)
+    return any(opaque_tag(value.strip()) == tag for value in if_none_match.split(","))
+
+
+class ResponseCache:
+    """
+    Response bodies of event queries in LRU order, up to max_bytes of them
+    in total. Entries given a ttl expire after it, the others stay until
+    they are evicted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ The (body, headers, etag) stored for key, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] is not None and entry[3] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[:3]
+
+    def put(self, key, body, headers, tag, ttl=None):
+        # A single response larger than a quarter of the budget would push
+        # out most of the cache
+        if len(body) > self.max_bytes // 4:
+            return
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, headers, tag, expires)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        body = self._entries.pop(key)[0]
+        self.bytes -= len(body)
+
+    def to_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,80 @@
+from sqlalchemy import func
+from sqlalchemy.dialects import mysql, sqlite
+from models import minuteRollup, hourRollup
+
+# Rollup tables and the size of their buckets
+BUCKETS = {
+    "minute": minuteRollup.__table__,
+    "hour": hourRollup.__table__,
+}
+
+# The reading that is rolled up for each event type
+VALUE_FIELDS = {
+    "temperature": "temperature",
+    "motion": "motion_intensity",
+}
+
+
+def bucket_start(timestamp, bucket):
+    if bucket == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def aggregate(rows_by_type, bucket):
+    """ Rolls rows of the event tables up into one count/sum/min/max row per device and bucket """
+    rollups = {}
+    for event_type, rows in rows_by_type.items():
+        field = VALUE_FIELDS[event_type]
+        for row in rows:
+            key = (event_type, row["device_id"], bucket_start(row["timestamp"], bucket))
+            value = row[field]
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = [1, value, value, value]
+            else:
+                rollup[0] += 1
+                rollup[1] += value
+                if value < rollup[2]:
+                    rollup[2] = value
+                if value > rollup[3]:
+                    rollup[3] = value
+
+    return [
+        {"event_type": event_type, "device_id": device_id, "bucket_start": start,
+         "count": count, "sum": total, "min": low, "max": high}
+        for (event_type, device_id, start), (count, total, low, high) in rollups.items()
+    ]
+
+
+def upsert(dialect_name, table):
+    """ INSERT that merges into an existing bucket row, for MySQL and SQLite """
+    if dialect_name == "mysql":
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update(
+            count=table.c["count"] + statement.inserted["count"],
+            sum=table.c["sum"] + statement.inserted["sum"],
+            min=func.least(table.c["min"], statement.inserted["min"]),
+            max=func.greatest(table.c["max"], statement.inserted["max"]),
+        )
+    if dialect_name == "sqlite":
+        statement = sqlite.insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={
+                "count": table.c["count"] + statement.excluded["count"],
+                "sum": table.c["sum"] + statement.excluded["sum"],
+                "min": func.min(table.c["min"], statement.excluded["min"]),
+                "max": func.max(table.c["max"], statement.excluded["max"]),
+            }
+        )
+    raise ValueError(f"Rollups are not supported on {dialect_name}")
+
+
+def update_rollups(connection, rows_by_type, buckets=BUCKETS):
+    """ Adds newly stored event rows to the rollup tables, inside the caller's transaction """
+    for bucket in buckets:
+        table = BUCKETS[bucket]
+        rollups = aggregate(rows_by_type, bucket)
+        if rollups:
+            connection.execute(upsert(connection.dialect.name, table), rollups)
@@ -0,0 +1,110 @@
+"""
+Runs storage with several processes serving the API and a single
+ingestion process running the Kafka consumers and archiving.
+
+    python3 serve.py
+
+app.py keeps running everything in one process when started directly.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import multiprocessing
+from threading import Thread
+import yaml
+import uvicorn
+import log_setup
+
+ENV = os.environ.get('ENV', 'dev')
+CONFIG_PATH = os.environ.get('CONFIG_PATH', '../config')
+
+FULL_CONFIG_PATH = os.path.join(CONFIG_PATH, ENV, 'storage')
+LOG_CONF_FILE = os.path.join(FULL_CONFIG_PATH, 'storage_log_conf.yml')
+APP_CONF_FILE = os.path.join(FULL_CONFIG_PATH, 'storage_app_conf.yaml')
+
+logger = logging.getLogger('basicLogger')
+
+# Workers and the ingestion process are started fresh rather than forked,
+# so none of them inherits the supervisor's threads or connections
+context = multiprocessing.get_context('spawn')
+
+
+def run_ingestion_process(stopping):
+    """ Entry point of the ingestion process """
+    # Ctrl-C and signals sent to the whole process group reach this process
+    # too, the supervisor decides when it stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import app
+    sys.exit(app.run_ingestion(stopping))
+
+
+class IngestionSupervisor(Thread):
+    """
+    Keeps exactly one ingestion process running, starting a new one after
+    restart_delay_s whenever it exits. The delay doubles up to
+    max_restart_delay_s while the process keeps dying soon after starting.
+    """
+
+    def __init__(self, restart_delay_s=1, max_restart_delay_s=60):
+        super().__init__(name="ingestion-supervisor", daemon=True)
+        self.restart_delay_s = restart_delay_s
+        self.max_restart_delay_s = max_restart_delay_s
+        self.stopping = context.Event()
+        self.process = None
+
+    def run(self):
+        delay = self.restart_delay_s
+        while not self.stopping.is_set():
+            self.process = context.Process(target=run_ingestion_process, args=(self.stopping,), name="ingestion")
+            started = time.monotonic()
+            self.process.start()
+            logger.info(f"Started ingestion process {self.process.pid}")
+            self.process.join()
+            if self.stopping.is_set():
+                break
+
+            if time.monotonic() - started > self.max_restart_delay_s:
+                delay = self.restart_delay_s
+            logger.error(f"Ingestion process exited with code {self.process.exitcode}, restarting in {delay}s")
+            self.stopping.wait(delay)
+            delay = min(delay * 2, self.max_restart_delay_s)
+
+    def stop(self, timeout):
+        """ Lets the ingestion process flush and leave the consumer group, then kills it if it doesn't """
+        self.stopping.set()
+        self.join(timeout)
+        if self.process is not None and self.process.is_alive():
+            logger.warning(f"Ingestion process did not stop within {timeout}s, killing it")
+            self.process.kill()
+
+
+if __name__ == "__main__":
+    with open(LOG_CONF_FILE, 'r') as f:
+        log_setup.setup_logging(yaml.safe_load(f.read()))
+    with open(APP_CONF_FILE, 'r') as f:
+        app_conf = yaml.safe_load(f.read())
+    serving_conf = app_conf.get('serving', {})
+
+    # Creates and migrates the tables once, before any worker imports app.py.
+    # Workers and the ingestion process import db_setup again and would redo
+    # it, the flag they inherit tells them it's done
+    import db_setup
+    db_setup.engine.dispose()
+    os.environ['STORAGE_SCHEMA_READY'] = '1'
+
+    # Read workers report the ingestion process's consumer stats from this file
+    os.environ['INGESTION_STATUS_FILE'] = serving_conf.get('status_file', '/tmp/storage_ingestion.json')
+
+    logger.info("Storage Service starting...")
+    supervisor = IngestionSupervisor(serving_conf.get('restart_delay_s', 1),
+                                     serving_conf.get('max_restart_delay_s', 60))
+    supervisor.start()
+    try:
+        # Returns once the workers have stopped after SIGTERM or SIGINT
+        uvicorn.run("app:app", host="0.0.0.0", port=serving_conf.get('port', 8090),
+                    workers=serving_conf.get('workers', 4), log_config=None)
+    finally:
+        supervisor.stop(app_conf.get('consumers', {}).get('shutdown_timeout_s', 10) + 5)
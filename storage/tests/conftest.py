@@ -0,0 +1,42 @@
+"""
+Runs storage on the dev config, but against a SQLite database and with
+every file it writes in a temporary directory, so tests need no MySQL or
+Kafka.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import yaml
+
+STORAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(os.path.dirname(STORAGE_DIR), 'config', 'dev', 'storage')
+
+TMP_DIR = tempfile.mkdtemp(prefix='storage-tests-')
+TEST_CONFIG_DIR = os.path.join(TMP_DIR, 'config', 'dev', 'storage')
+shutil.copytree(CONFIG_DIR, TEST_CONFIG_DIR)
+
+with open(os.path.join(TEST_CONFIG_DIR, 'storage_app_conf.yaml')) as f:
+    app_conf = yaml.safe_load(f)
+app_conf['datastore']['backend'] = 'sqlite'
+app_conf['datastore']['path'] = os.path.join(TMP_DIR, 'storage.sqlite')
+app_conf['retention']['enabled'] = False
+app_conf['retention']['directory'] = os.path.join(TMP_DIR, 'archive')
+app_conf['dead_letter']['path'] = os.path.join(TMP_DIR, 'dead_letter.ndjson')
+with open(os.path.join(TEST_CONFIG_DIR, 'storage_app_conf.yaml'), 'w') as f:
+    yaml.safe_dump(app_conf, f)
+
+with open(os.path.join(TEST_CONFIG_DIR, 'storage_log_conf.yml')) as f:
+    log_conf = yaml.safe_load(f)
+log_conf['handlers']['file']['filename'] = os.path.join(TMP_DIR, 'storage.log')
+log_conf['queue']['enabled'] = False
+with open(os.path.join(TEST_CONFIG_DIR, 'storage_log_conf.yml'), 'w') as f:
+    yaml.safe_dump(log_conf, f)
+
+os.environ['ENV'] = 'dev'
+os.environ['CONFIG_PATH'] = os.path.join(TMP_DIR, 'config')
+sys.path.insert(0, STORAGE_DIR)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
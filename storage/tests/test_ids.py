@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+import app
+from db_setup import engine
+from ingest import write_rows
+from models import motionEvent
+
+
+def test_id_export_leaves_out_events_within_the_lag(monkeypatch):
+    now = datetime.now().replace(microsecond=0)
+    rows = [
+        {"device_id": "sensor-ids", "room": "hall", "motion_intensity": 3, "timestamp": now - timedelta(hours=1),
+         "trace_id": 4001},
+        {"device_id": "sensor-ids", "room": "hall", "motion_intensity": 5, "timestamp": now, "trace_id": 4002},
+    ]
+    with engine.begin() as connection:
+        write_rows(connection, {"motion": rows})
+
+    client = app.app.test_client()
+    response = client.get("/storage/motion/ids")
+    trace_ids = [event["trace_id"] for event in response.json()]
+    assert 4001 in trace_ids
+    assert 4002 not in trace_ids
+
+    # The held back event comes with the next export once the lag has passed
+    since_id = response.headers["X-Next-Since-Id"]
+    monkeypatch.setitem(app.app_conf['queries'], 'id_export_lag_s', -60)
+    response = client.get("/storage/motion/ids", params={"since_id": since_id})
+    assert 4002 in [event["trace_id"] for event in response.json()]
+
+
+def test_held_back_event_is_not_passed_by_the_watermark(monkeypatch):
+    # A low id with a fresh timestamp before a high id with an old one, as
+    # after a spool replay or from a lagging partition
+    now = datetime.now().replace(microsecond=0)
+    with engine.begin() as connection:
+        since_id = connection.execute(select(func.coalesce(func.max(motionEvent.id), 0))).scalar()
+        write_rows(connection, {"motion": [
+            {"device_id": "sensor-order", "room": "hall", "motion_intensity": 3, "timestamp": now,
+             "trace_id": 9001},
+            {"device_id": "sensor-order", "room": "hall", "motion_intensity": 5,
+             "timestamp": now - timedelta(minutes=5), "trace_id": 9002},
+        ]})
+
+    client = app.app.test_client()
+    response = client.get("/storage/motion/ids", params={"since_id": since_id})
+    assert response.json() == []
+    assert response.headers["X-Next-Since-Id"] == str(since_id)
+
+    monkeypatch.setitem(app.app_conf['queries'], 'id_export_lag_s', -60)
+    response = client.get("/storage/motion/ids", params={"since_id": since_id})
+    assert [event["trace_id"] for event in response.json()] == [9001, 9002]
@@ -0,0 +1,124 @@
+import json
+from collections import namedtuple
+import pytest
+from sqlalchemy import select, func
+import counters
+import ingest
+import rollups
+import wire
+from db_setup import engine
+from ingest import BatchConsumer, event_row, TABLES
+
+Message = namedtuple("Message", ["value", "offset"])
+
+
+class FakeConsumer:
+    def __init__(self):
+        self.commits = 0
+
+    def commit_offsets(self):
+        self.commits += 1
+
+
+class FakeDeadLetter:
+    def __init__(self):
+        self.messages = []
+
+    def add(self, consumer, message, error):
+        self.messages.append((message.offset, error))
+
+
+def temperature(trace_id, value=21):
+    return {
+        "type": "temperature",
+        "datetime": "2024-05-01T10:00:00",
+        "payload": {"device_id": "thermostat-1", "temperature": value, "event_type": "temperature",
+                    "trace_id": trace_id}
+    }
+
+
+def message(offset, msg):
+    return Message(json.dumps(msg).encode('utf-8'), offset)
+
+
+def stored(trace_ids):
+    table = TABLES["temperature"]
+    with engine.connect() as connection:
+        return connection.execute(
+            select(func.count()).select_from(table).where(table.c.trace_id.in_(trace_ids))
+        ).scalar()
+
+
+@pytest.mark.parametrize("value", [None, "21", True])
+def test_event_row_rejects_bad_readings(value):
+    with pytest.raises(ValueError):
+        event_row(temperature(1, value))
+
+
+def test_event_row_rejects_missing_fields():
+    msg = temperature(1)
+    del msg["payload"]["device_id"]
+    with pytest.raises(ValueError):
+        event_row(msg)
+
+
+def test_bad_messages_are_quarantined_and_the_batch_committed():
+    consumer, dead_letter = FakeConsumer(), FakeDeadLetter()
+    batch_consumer = BatchConsumer(consumer, engine, wire.decode, rollups=True, counters=True,
+                                   dead_letter=dead_letter)
+    with engine.connect() as connection:
+        batch_consumer.flush(connection, [
+            message(0, temperature(1001)), message(1, temperature(1002, None)), message(2, temperature(1003))
+        ])
+
+    assert consumer.commits == 1
+    assert [offset for offset, _ in dead_letter.messages] == [1]
+    assert stored([1001, 1002, 1003]) == 2
+
+
+def test_batch_failing_outside_the_database_is_written_one_row_at_a_time(monkeypatch):
+    aggregate = rollups.aggregate
+
+    def failing_aggregate(rows_by_type, bucket):
+        if any(row["trace_id"] == 2002 for rows in rows_by_type.values() for row in rows):
+            raise TypeError("unsupported operand")
+        return aggregate(rows_by_type, bucket)
+
+    monkeypatch.setattr(rollups, "aggregate", failing_aggregate)
+    consumer, dead_letter = FakeConsumer(), FakeDeadLetter()
+    batch_consumer = BatchConsumer(consumer, engine, wire.decode, rollups=True, dead_letter=dead_letter)
+    with engine.connect() as connection:
+        batch_consumer.flush(connection, [
+            message(0, temperature(2001)), message(1, temperature(2002)), message(2, temperature(2003))
+        ])
+
+    assert consumer.commits == 1
+    assert [offset for offset, _ in dead_letter.messages] == [1]
+    assert stored([2001, 2002, 2003]) == 2
+
+
+def test_rows_stored_by_another_writer_are_not_counted(monkeypatch):
+    with engine.connect() as connection:
+        BatchConsumer(FakeConsumer(), engine, wire.decode, counters=True).flush(
+            connection, [message(0, temperature(3001))])
+        before = counters.read_totals(connection)["temperature"]
+
+    # The first lookup misses 3001, as if another consumer committed it right after
+    lookup = ingest.stored_trace_ids
+    calls = []
+
+    def racing_lookup(connection, table, rows):
+        calls.append(len(rows))
+        return set() if len(calls) == 1 else lookup(connection, table, rows)
+
+    monkeypatch.setattr(ingest, "stored_trace_ids", racing_lookup)
+    consumer, dead_letter = FakeConsumer(), FakeDeadLetter()
+    batch_consumer = BatchConsumer(consumer, engine, wire.decode, counters=True, dead_letter=dead_letter)
+    with engine.connect() as connection:
+        batch_consumer.flush(connection, [message(1, temperature(3001)), message(2, temperature(3002))])
+        after = counters.read_totals(connection)["temperature"]
+
+    assert consumer.commits == 1
+    assert dead_letter.messages == []
+    assert stored([3001, 3002]) == 2
+    assert after - before == 1
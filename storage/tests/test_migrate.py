@@ -0,0 +1,29 @@
+from datetime import datetime
+from sqlalchemy import create_engine, inspect, select, text
+from counters import read_totals
+from db_setup import migrate_indexes
+from models import Base, temperatureEvent
+
+
+def test_unique_index_is_built_over_duplicates(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.sqlite'}")
+    Base.metadata.create_all(engine)
+    table = temperatureEvent.__table__
+    now = datetime.now().replace(microsecond=0)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_temperature_trace_id"))
+        connection.execute(table.insert(), [
+            {"device_id": "thermostat-1", "temperature": temperature, "timestamp": now, "event_type": "temperature",
+             "trace_id": trace_id}
+            for trace_id, temperature in ((1, 20), (2, 21), (1, 22), (1, 23), (3, 24), (2, 25))
+        ])
+
+    migrate_indexes(engine)
+
+    assert "ix_temperature_trace_id" in {index["name"] for index in inspect(engine).get_indexes("temperature")}
+    with engine.connect() as connection:
+        rows = connection.execute(select(table.c.trace_id, table.c.temperature).order_by(table.c.id)).all()
+        totals = read_totals(connection)
+    # The first row of each trace ID is kept
+    assert rows == [(1, 20), (2, 21), (3, 24)]
+    assert totals["temperature"] == 3
@@ -0,0 +1,27 @@
+import logging
+import app
+
+
+def test_log_rebalance_takes_held_offsets(caplog):
+    logger = logging.getLogger('basicLogger')
+    logger.addHandler(caplog.handler)
+    try:
+        # pykafka passes held_offsets, partition id to offset, -2 for partitions not read yet
+        result = app.log_rebalance("consumer-0", None, {0: 12}, {2: -2, 0: 12, 1: 40})
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    # None keeps the offsets pykafka would use anyway
+    assert result is None
+    assert "consumer-0 now owns partitions [0, 1, 2]" in caplog.text
+
+
+def test_log_rebalance_without_partitions(caplog):
+    logger = logging.getLogger('basicLogger')
+    logger.addHandler(caplog.handler)
+    try:
+        app.log_rebalance("consumer-1", None, {0: 12}, {})
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    assert "consumer-1 now owns partitions []" in caplog.text
@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+import app
+from response_cache import ResponseCache, etag, etag_matches
+
+
+def test_etag_matches_uses_weak_comparison():
+    tag = etag(b"[]")
+    assert etag_matches(tag, tag)
+    assert etag_matches("W/" + tag, tag)
+    assert etag_matches('"other", W/' + tag, tag)
+    assert etag_matches(tag, "W/" + tag)
+    assert etag_matches("*", tag)
+    assert not etag_matches('W/"other"', tag)
+    assert not etag_matches(None, tag)
+
+
+def test_closed_ranges_expire(monkeypatch):
+    closed = datetime.now() - timedelta(days=1)
+    assert app.cache_ttl(closed) == app.cache_conf.get('closed_ttl_s', 600)
+    assert app.cache_ttl(datetime.now()) == app.cache_conf.get('open_ttl_s', 0)
+
+    now = [1000.0]
+    monkeypatch.setattr("response_cache.time.monotonic", lambda: now[0])
+    cache = ResponseCache(1024)
+    cache.put("key", b"[]", {}, etag(b"[]"), app.cache_ttl(closed))
+    assert cache.get("key") is not None
+    now[0] += app.cache_ttl(closed) + 1
+    assert cache.get("key") is None
@@ -0,0 +1,123 @@
+import json
+import struct
+import time
+import calendar
+
+# Wire format for event messages on the Kafka topic.
+#
+# JSON messages always start with "{". Binary messages start with a one byte
+# schema version instead, so consumers can read both while producers are
+# switched over one at a time.
+#
+# Version 1 layout (big endian):
+#   B  version
+#   B  event type (1 = temperature, 2 = motion)
+#   B  flags (bit 0: value is an integer)
+#   q  trace_id
+#   I  datetime as seconds since the epoch
+#   d  temperature or motion_intensity
+#   B  length + utf-8 device_id
+#   B  length + utf-8 event_type (temperature) or room (motion)
+
+JSON = 'json'
+BINARY = 'binary'
+
+VERSION_1 = 1
+HEADER_V1 = struct.Struct('>BBBqId')
+DATETIME_FORMAT = "%04d-%02d-%02dT%02d:%02d:%02d"
+
+EVENT_TYPES = {"temperature": 1, "motion": 2}
+EVENT_NAMES = {code: name for name, code in EVENT_TYPES.items()}
+FLAG_INT_VALUE = 0x01
+
+
+def encode(msg, encoding=JSON):
+    """
+    Encodes an event message. Messages that don't fit the binary layout
+    (unknown type, strings over 255 bytes) are sent as JSON instead.
+    """
+    if encoding == BINARY:
+        data = _encode_v1(msg)
+        if data is not None:
+            return data
+    return json.dumps(msg).encode('utf-8')
+
+
+def decode(data):
+    """ Decodes an event message in either wire format """
+    if data[:1] == b'{':
+        return json.loads(data.decode('utf-8'))
+    if data[0] == VERSION_1:
+        return _decode_v1(data)
+    raise ValueError(f"Unknown message format version {data[0]}")
+
+
+def _encode_v1(msg):
+    payload = msg["payload"]
+    event_type = EVENT_TYPES.get(msg["type"])
+    if event_type is None:
+        return None
+
+    if msg["type"] == "temperature":
+        value = payload["temperature"]
+        label = payload["event_type"]
+    else:
+        value = payload["motion_intensity"]
+        label = payload["room"]
+
+    device_id = payload["device_id"].encode('utf-8')
+    label = label.encode('utf-8')
+    if len(device_id) > 255 or len(label) > 255:
+        return None
+
+    flags = FLAG_INT_VALUE if isinstance(value, int) else 0
+    # Fixed "%Y-%m-%dT%H:%M:%S" layout, sliced directly since strptime is slow
+    text = msg["datetime"]
+    timestamp = calendar.timegm((
+        int(text[0:4]), int(text[5:7]), int(text[8:10]),
+        int(text[11:13]), int(text[14:16]), int(text[17:19])
+    ))
+
+    return b''.join((
+        HEADER_V1.pack(VERSION_1, event_type, flags, payload["trace_id"], timestamp, value),
+        bytes((len(device_id),)), device_id,
+        bytes((len(label),)), label,
+    ))
+
+
+def _decode_v1(data):
+    _, event_type, flags, trace_id, timestamp, value = HEADER_V1.unpack_from(data)
+    offset = HEADER_V1.size
+    device_id, offset = _read_string(data, offset)
+    label, offset = _read_string(data, offset)
+
+    if flags & FLAG_INT_VALUE:
+        value = int(value)
+
+    name = EVENT_NAMES[event_type]
+    if name == "temperature":
+        payload = {
+            "trace_id": trace_id,
+            "device_id": device_id,
+            "temperature": value,
+            "event_type": label,
+        }
+    else:
+        payload = {
+            "trace_id": trace_id,
+            "device_id": device_id,
+            "room": label,
+            "motion_intensity": value,
+        }
+
+    return {
+        "type": name,
+        "datetime": DATETIME_FORMAT % time.gmtime(timestamp)[:6],
+        "payload": payload
+    }
+
+
+def _read_string(data, offset):
+    length = data[offset]
+    start = offset + 1
+    return data[start:start + length].decode('utf-8'), start + length